@@ -1,17 +1,41 @@
-from google.protobuf import json_format
-from google.protobuf.descriptor import FieldDescriptor
-from google.protobuf.message import DecodeError
-import argparse
-import pkgutil
+# Only cheap modules are imported here, so that commands start quickly.
+# Everything else (including protobuf) is imported where it's needed.
+import base64
+import contextlib
 import json
+import math
 import os
-import shutil
-import subprocess
 import sys
 
 
+VERSION = "0.9.0"
+# Keep in sync with requirements.txt.
+MIN_PROTOBUF_VERSION = "4.21.0"
+
 DOTFILE_PATH = os.path.expanduser("~/.protopad/config.json")
 TEMPFILE_PATH = os.path.expanduser("~/.protopad/temp.json")
+SOCKET_PATH = os.path.expanduser("~/.protopad/protopad.sock")
+COMPILED_PATH = os.path.expanduser("~/.protopad/compiled")
+
+TYPE_INDEX_FILENAME = "index.json"
+TYPE_INDEX_VERSION = 2
+
+RECORD_INDEX_SUFFIX = ".idx"
+RECORD_INDEX_MAGIC = b"PPIDX001"
+
+TEMPLATE_CACHE_FILENAME = "templates.json"
+TEMPLATE_MAX_DEPTH = 16
+
+EXPORT_FORMATS = ["csv", "parquet", "npy"]
+EXPORT_BATCH_SIZE = 1024
+
+COMPILE_MANIFEST_FILENAME = "manifest.json"
+COMPILE_MODES = ["python", "descriptor_set"]
+DESCRIPTOR_SET_FILENAME = "descriptors.pb"
+DESCRIPTOR_SETS_DIRNAME = "descriptor_sets"
+PROTOC_BATCH_SIZE = 64
+JSON_WHITESPACE = b" \t\r\n"
+PROTO_IMPORT_PATTERN = rb'\bimport\s+(?:public\s+|weak\s+)?"([^"]+)"\s*;'
 
 
 def eprint(*args, **kwargs):
@@ -23,50 +47,145 @@ def fail(status, message):
     exit(status)
 
 
+class ProtopadError(Exception):
+    pass
+
+
+# A message type that isn't registered, or is ambiguous.
+class UnknownTypeError(ProtopadError):
+    pass
+
+
+# Input that can't be parsed as the message type.
+class InvalidInputError(ProtopadError):
+    pass
+
+
+class CompileError(ProtopadError):
+    pass
+
+
+# Modules of protobuf that are used for every record or value are only
+# imported once, and then looked up here. They can't be imported at the top
+# like the cheap modules, because most commands don't need protobuf.
+_protobuf_modules = {}
+
+
+def protobuf_module(name):
+    module = _protobuf_modules.get(name)
+    if module is None:
+        import importlib
+
+        module = _protobuf_modules[name] = importlib.import_module("google.protobuf." + name)
+    return module
+
+
 def parse_proto_or_fail(proto, binary, message):
     try:
         proto.ParseFromString(binary)
-    except DecodeError:
-        fail(1, message)
+    except protobuf_module("message").DecodeError:
+        raise InvalidInputError(message)
+
 
+# The caches shared between threads (like message classes, descriptor pools
+# and internal plans) are filled under this lock, and the profiler records
+# stages under its own. They're only created when they're first needed,
+# because importing threading slows down every command.
+_locks = {}
 
-def get_json_name(pyname):
-    if "_" not in pyname:
-        return pyname
 
-    words = pyname.split("_")
-    late_words = [w.capitalize() for w in words[1:]]
-    words = [words[0]] + late_words
-    return "".join(words)
+def shared_lock(name):
+    import threading
+
+    lock = _locks.get(name)
+    if lock is None:
+        lock = _locks.setdefault(name, threading.RLock())
+    return lock
+
+
+def cache_lock():
+    return shared_lock("cache")
 
 
 def protopad(args):
     app = Protopad(args["verbose"])
 
-    message_desc = app.get_message_desc(
-        args["type"]) if "type" in args else None
-    internal_type = args.get("internal_type")
-    internal_desc = app.get_message_desc(
-        internal_type) if internal_type else None
-
     command = args["task"]
-    if command == "json":
+    if command in ("json", "proto") and app.convert_with_daemon(args):
+        return
+    elif command == "register" and args["list"]:
+        app.list_registered_paths()
+        return
+
+    protobuf_version = check_protobuf_version()
+    app.log(
+        f"Using protobuf {protobuf_version} ({protobuf_backend()} backend)")
+    if command == "serve":
+        app.serve(args["socket"])
+        return
+
+    with _profiler.stage("get_message_desc"):
+        message_desc = app.get_message_desc(
+            args["type"]) if "type" in args else None
+        internal_type = args.get("internal_type")
+        internal_desc = resolve_internal_types(
+            app.get_message_desc, message_desc, internal_type,
+            args.get("internal_field")) if message_desc else None
+
+    input_format = args.get("input_format", "auto")
+    fields = args.get("fields")
+    field_selection = select_fields(
+        fields, message_desc, internal_desc) if fields else None
+
+    if command in ("json", "proto") and (args.get("record") is not None
+                                         or args.get("range") or args.get("key")):
+        if args.get("batch") or args.get("stream") == "lines":
+            fail(1, "The `--record`, `--range` and `--key` options only work with a file of length-delimited records.")
+        app.convert_indexed_records(command, message_desc, internal_desc, args.get("file"),
+                                    args.get("output"), args.get("record"), args.get("range"),
+                                    args.get("key"), input_format, field_selection)
+    elif command in ("json", "proto") and args.get("batch"):
+        if args.get("file") or args.get("stream"):
+            fail(1, "The `--batch` option can't be combined with an input file or `--stream`.")
+        if not args.get("output"):
+            fail(1, "The `--batch` option requires an output directory (`--output`).")
+        app.convert_batch(command, args["type"], internal_type,
+                          args["batch"], args["output"], args.get("jobs"),
+                          input_format, fields, args.get("internal_field"))
+    elif command == "json" and args.get("stream"):
+        app.stream_to_json(message_desc, internal_desc, args.get("file"),
+                           args.get("output"), args["stream"], input_format,
+                           args["incremental"], field_selection)
+    elif command == "json":
         app.read_to_json(message_desc, internal_desc,
-                         args.get("file"), args.get("output"))
+                         args.get("file"), args.get("output"), input_format,
+                         args["incremental"], field_selection)
+    elif command == "query":
+        app.query_records(message_desc, internal_desc, args.get("file"), args.get("output"),
+                          args["stream"], args["where"], args["output_format"],
+                          input_format, field_selection, args.get("limit"))
+    elif command == "export":
+        app.export_records(message_desc, internal_desc, args.get("file"), args.get("output"),
+                           args["stream"], args["format"], input_format, fields,
+                           args.get("explode"), args["batch_size"])
+    elif command == "proto" and args.get("stream"):
+        app.stream_to_proto(message_desc, internal_desc, args.get("file"),
+                            args.get("output"), args["stream"], input_format)
     elif command == "proto":
         app.read_to_proto(message_desc, internal_desc,
-                          args.get("file"), args.get("output"))
+                          args.get("file"), args.get("output"), input_format)
     elif command == "edit":
         if not (sys.stdin.isatty() and sys.stdout.isatty()):
             fail(1, "Cannot use terminal pipes with the edit command.\n"
                     "Use the `file` and `--output` parameters instead.")
         app.edit_message(message_desc, internal_desc, args.get("file"), args.get(
-            "output"), args["empty"], args["recent"], args.get("editor"))
+            "output"), args["empty"], args["recent"], args.get("editor"), input_format,
+            args.get("template_depth", TEMPLATE_MAX_DEPTH))
     elif command == "register":
-        if args["list"]:
-            app.list_registered_paths()
-        elif args["recompile"]:
-            app.recompile_protos()
+        if args["recompile"]:
+            app.recompile_protos(args["full"])
+        elif args["compile_mode"]:
+            app.set_compile_mode(args["compile_mode"])
         else:
             app.register_proto_path(args["path"], args["remove"])
     else:
@@ -86,79 +205,514 @@ class Protopad:
         message_type_name = split_name[-1]
         prefix = split_name[0] if len(split_name) > 1 else ""
 
-        import_path = os.path.expanduser("~/.protopad/compiled")
-        options = []
-        for loader, module_name, is_pkg in pkgutil.walk_packages([import_path]):
-            try:
-                self.log(f"Loading module: {module_name}")
-                module = loader.find_module(
-                    module_name).load_module(module_name)
-                descriptor = getattr(module, "DESCRIPTOR", None)
-                if descriptor:
-                    for message_type, message_desc in descriptor.message_types_by_name.items():
-                        self.log(f"  Found message type: {message_type}")
-                        options.append(
-                            (message_type, message_desc, module_name))
-                else:
-                    self.log(f"  No descriptor in module.")
-            except AssertionError:
-                self.log(f"  (Module {module_name} could not be loaded.)")
-                continue
-
+        index = self.load_type_index()
+        options = index["types"]
         if not options:
-            fail(1, "Failed to load any message types at all."
-                    "Check your registered paths with `protopad register --list`")
+            raise UnknownTypeError("Failed to load any message types at all."
+                                "Check your registered paths with `protopad register --list`")
 
         selection = [option
                      for option in options
-                     if option[0] == message_type_name and prefix in option[2]]
+                     if option[0] == message_type_name and prefix in option[1]]
 
         if not selection:
-            fail(1, f"Unknown message type '{message_type_name}'")
+            raise UnknownTypeError(f"Unknown message type '{message_type_name}'")
         elif len(selection) > 1:
-            eprint(
-                f"Message type '{message_type_name}' is ambiguous. Possibilities are:")
-            for (name, _, module_name) in selection:
-                eprint(f"- {module_name}.{name}")
-            fail(
-                1, f"Add any unambiguous prefix to the type name to specify. (e.g. `prefix.TypeName`)")
+            lines = [f"Message type '{message_type_name}' is ambiguous. Possibilities are:"]
+            for (name, module_name, *_) in selection:
+                lines.append(f"- {module_name}.{name}")
+            lines.append(
+                "Add any unambiguous prefix to the type name to specify. (e.g. `prefix.TypeName`)")
+            raise UnknownTypeError("\n".join(lines))
+
+        (_, module_name, full_name, file_name) = selection[0]
+        if index.get("compile_mode") == "descriptor_set":
+            self.log(f"Loading descriptors for: {file_name}")
+            return load_compiled_message_desc(file_name, full_name)
+
+        self.log(f"Loading module: {module_name}")
+        module = import_compiled_module(module_name)
+        return module.DESCRIPTOR.message_types_by_name[message_type_name]
+
+    def load_type_index(self):
+        try:
+            with open(type_index_path(), "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = None
+
+        if (index is None
+                or index.get("version") != TYPE_INDEX_VERSION
+                or index.get("stamp") != compiled_tree_stamp()):
+            self.log("Message type index is missing or out of date.")
+            index = self.build_type_index()
+
+        return index
+
+    def build_type_index(self):
+        self.log("Indexing message types...")
+        compile_mode = read_compile_manifest().get("compile_mode", "python")
+        if compile_mode == "descriptor_set":
+            types = self.index_descriptor_set()
+        else:
+            types = self.index_compiled_modules()
 
-        (_, desc, _) = selection[0]
-        return desc
+        index = {
+            "version": TYPE_INDEX_VERSION,
+            "stamp": compiled_tree_stamp(),
+            "compile_mode": compile_mode,
+            "types": types,
+        }
 
-    def read_to_json(self, message_desc, internal_desc, infile, outfile):
-        base = read_any_input(message_desc, internal_desc, infile)
-        result = proto_to_json(base, internal_desc)
+        # The index is only a cache, so failing to write it is not fatal.
+        try:
+            write_json_atomically(type_index_path(), index)
+        except OSError as e:
+            self.log(f"  (Could not write message type index: {e})")
 
-        if outfile:
-            with open(outfile, "w") as f:
-                f.write(result)
-        else:
-            print(result)
+        self.log("Done.")
+        return index
+
+    def index_compiled_modules(self):
+        module_names = []
+        for (dirpath, _, filenames) in os.walk(COMPILED_PATH):
+            for filename in filenames:
+                if filename.endswith("_pb2.py"):
+                    relpath = os.path.relpath(os.path.join(dirpath, filename), COMPILED_PATH)
+                    module_names.append(os.path.splitext(relpath)[0].replace(os.sep, "."))
+
+        types = []
+        for module_name in sorted(module_names):
+            try:
+                self.log(f"  Loading module: {module_name}")
+                module = import_compiled_module(module_name)
+            except Exception as e:
+                # One broken module shouldn't stop the others being indexed.
+                self.log(f"  (Module {module_name} could not be loaded: {e})", always=True)
+                continue
 
-    def read_to_proto(self, message_desc, internal_desc, infile, outfile):
-        base = read_any_input(message_desc, internal_desc, infile)
-        result = base.SerializeToString()
+            descriptor = getattr(module, "DESCRIPTOR", None)
+            if descriptor:
+                for message_type, message_desc in descriptor.message_types_by_name.items():
+                    self.log(f"    Found message type: {message_type}")
+                    types.append([message_type, module_name,
+                                  message_desc.full_name, descriptor.name])
+            else:
+                self.log(f"    No descriptor in module.")
+        return types
+
+    def index_descriptor_set(self):
+        # The descriptor set also contains imports from outside the registered
+        # paths (like the well-known types), which aren't indexed.
+        registered = set()
+        for hashes in read_compile_manifest().get("sources", {}).values():
+            registered.update(hashes)
+
+        types = []
+        try:
+            file_set = read_descriptor_set(descriptor_set_path())
+        except FileNotFoundError:
+            return types
+
+        for file_proto in file_set.file:
+            if file_proto.name not in registered:
+                continue
+            self.log(f"  Loading descriptors: {file_proto.name}")
+            module_name = os.path.splitext(file_proto.name)[0].replace("/", ".") + "_pb2"
+            prefix = file_proto.package + "." if file_proto.package else ""
+            for message_proto in file_proto.message_type:
+                self.log(f"    Found message type: {message_proto.name}")
+                types.append([message_proto.name, module_name,
+                              prefix + message_proto.name, file_proto.name])
+        return types
+
+    def read_to_json(self, message_desc, internal_desc, infile, outfile, input_format="auto", incremental=False, fields=None):
+        base = read_any_input(message_desc, internal_desc,
+                              infile, input_format, fields)
+        if incremental:
+            with _profiler.stage("write_json"), open_output_stream(outfile, "w") as outstream:
+                write_json(outstream, base, internal_desc)
+                if not outfile:
+                    outstream.write("\n")
+            return
+
+        with _profiler.stage("proto_to_json") as stage:
+            result = proto_to_json(base, internal_desc)
+            stage.nbytes = len(result)
+
+        with _profiler.stage("write_output", len(result)):
+            if outfile:
+                with open(outfile, "w") as f:
+                    f.write(result)
+            else:
+                print(result)
 
+    def read_to_proto(self, message_desc, internal_desc, infile, outfile, input_format="auto"):
+        base = read_any_input(message_desc, internal_desc,
+                              infile, input_format)
+        with _profiler.stage("serialize") as stage:
+            result = base.SerializeToString()
+            stage.nbytes = len(result)
+
+        with _profiler.stage("write_output", len(result)):
+            if outfile:
+                with open(outfile, "wb") as f:
+                    f.write(result)
+            else:
+                sys.stdout.buffer.write(result)
+
+    def stream_to_json(self, message_desc, internal_desc, infile, outfile, framing, input_format="auto", incremental=False, fields=None):
+        input_format = stream_record_format(framing, input_format)
+        with open_input_stream(infile) as instream, open_output_stream(outfile, "w") as outstream:
+            for record in read_records(instream, framing):
+                base = parse_any_input(
+                    record, message_desc, internal_desc, input_format, fields)
+                if incremental:
+                    with _profiler.stage("write_json"):
+                        write_json(outstream, base, internal_desc, indent=None)
+                        outstream.write("\n")
+                    continue
+
+                with _profiler.stage("proto_to_json") as stage:
+                    result = proto_to_json(base, internal_desc, indent=None)
+                    stage.nbytes = len(result)
+                with _profiler.stage("write_output", len(result) + 1):
+                    outstream.write(result)
+                    outstream.write("\n")
+
+    # Records are decoded into columns a batch at a time, and each batch is
+    # written before the next one is read.
+    def export_records(self, message_desc, internal_desc, infile, outfile, framing,
+                       output_format="csv", input_format="auto", fields=None, explode=None,
+                       batch_size=EXPORT_BATCH_SIZE):
+        input_format = stream_record_format(framing, input_format)
+        plan = ExportPlan(message_desc, internal_desc, fields, explode)
+        # Like for `query`, only the pure-Python backend parses less by pruning.
+        selection = select_fields(",".join(
+            column.name for column in plan.columns), message_desc,
+            internal_desc) if fields and prune_before_parsing() else None
+
+        with contextlib.ExitStack() as stack:
+            if output_format == "csv":
+                outstream = stack.enter_context(open_output_stream(outfile, "w"))
+                writer = CsvExportWriter(outstream, plan.columns)
+            elif not outfile:
+                raise ProtopadError(
+                    f"Exporting to {output_format} needs an output file (`--output`).")
+            elif output_format == "parquet":
+                writer = ParquetExportWriter(outfile, plan.columns)
+            else:
+                writer = NpyExportWriter(outfile, plan.columns)
+
+            instream = stack.enter_context(open_input_stream(infile))
+            batch = ExportBatch(plan.columns)
+            records = 0
+            for record in read_records(instream, framing):
+                base = parse_any_input(
+                    record, message_desc, internal_desc, input_format, selection)
+                with _profiler.stage("extract_columns"):
+                    for row in plan.extract(base):
+                        batch.add(row)
+                records += 1
+                if batch.count >= batch_size:
+                    with _profiler.stage("write_output"):
+                        writer.write_batch(batch)
+                    batch = ExportBatch(plan.columns)
+
+            with _profiler.stage("write_output"):
+                if batch.count or records == 0:
+                    writer.write_batch(batch)
+                writer.close()
+            self.log(f"Exported {records} records in {len(plan.columns)} columns.")
+
+    def stream_to_proto(self, message_desc, internal_desc, infile, outfile, framing, input_format="auto"):
+        input_format = stream_record_format(framing, input_format)
+        with open_input_stream(infile) as instream, open_output_stream(outfile, "wb") as outstream:
+            for record in read_records(instream, framing):
+                base = parse_any_input(
+                    record, message_desc, internal_desc, input_format)
+                with _profiler.stage("serialize") as stage:
+                    result = base.SerializeToString()
+                    stage.nbytes = len(result)
+                with _profiler.stage("write_output", len(result)):
+                    write_delimited_record(outstream, result)
+
+    # Only the records that match the conditions are converted.
+    def query_records(self, message_desc, internal_desc, infile, outfile, framing, conditions,
+                      output_format="json", input_format="auto", fields=None, limit=None):
+        input_format = stream_record_format(framing, input_format)
+        conditions = [QueryCondition(condition, message_desc, internal_desc)
+                      for condition in conditions]
+        # The pure-Python backend checks the conditions on a copy of each record
+        # that only has the fields they use. The native backends parse whole
+        # records faster than the fields can be skipped in Python.
+        condition_fields = select_fields(",".join(
+            condition.path for condition in conditions), message_desc,
+            internal_desc) if prune_before_parsing() else None
+
+        matches = 0
+        mode = "w" if output_format == "json" else "wb"
+        with open_input_stream(infile) as instream, open_output_stream(outfile, mode) as outstream:
+            for record in read_records(instream, framing):
+                if limit is not None and matches >= limit:
+                    break
+
+                candidate = parse_any_input(
+                    record, message_desc, internal_desc, input_format, condition_fields)
+                with _profiler.stage("match_conditions"):
+                    if not all(condition.matches(candidate) for condition in conditions):
+                        continue
+                matches += 1
+
+                base = candidate if condition_fields is None and fields is None else parse_any_input(
+                    record, message_desc, internal_desc, input_format, fields)
+                if output_format == "json":
+                    with _profiler.stage("proto_to_json") as stage:
+                        result = proto_to_json(base, internal_desc, indent=None)
+                        stage.nbytes = len(result)
+                    with _profiler.stage("write_output", len(result) + 1):
+                        outstream.write(result)
+                        outstream.write("\n")
+                else:
+                    with _profiler.stage("serialize") as stage:
+                        result = base.SerializeToString()
+                        stage.nbytes = len(result)
+                    with _profiler.stage("write_output", len(result)):
+                        write_delimited_record(outstream, result)
+
+        self.log(f"Found {matches} matching records.")
+
+    # Converts some of the records of a length-delimited file, which are found
+    # with an index file next to it, instead of reading the whole file.
+    def convert_indexed_records(self, task, message_desc, internal_desc, infile, outfile,
+                                record=None, record_range=None, key=None, input_format="auto",
+                                fields=None):
+        if not infile:
+            raise ProtopadError(
+                "Records can only be found by index in a file, not in stdin.")
+        input_format = stream_record_format("delimited", input_format)
+
+        (key_path, key_function) = (None, None)
+        if key:
+            (key_path, _, key_text) = key.partition("=")
+            steps = resolve_field_path(key_path, message_desc, internal_desc)
+            key_field = steps[-1][0]
+            if is_repeated(key_field) or key_field.type == key_field.TYPE_BYTES:
+                raise ProtopadError(
+                    f"The field `{key_field.name}` can't be used as a key")
+            key_value = parse_field_value(key_field, unquote(key_text))
+            key_fields = select_fields(key_path, message_desc, internal_desc)
+
+            def read_key(data):
+                message = parse_any_input(
+                    data, message_desc, internal_desc, input_format, key_fields)
+                values = field_path_values(message, steps, defaults=True)
+                return values[0] if values else None
+            key_function = read_key
+
+        with _profiler.stage("record_index"):
+            index = self.open_record_index(infile, key_path, key_function)
+
+        count = index.header["count"]
+        if record is not None:
+            number = record + count if record < 0 else record
+            if not 0 <= number < count:
+                raise ProtopadError(
+                    f"Record {record} is out of range: {infile} has {count} records.")
+            selections = [(number, number + 1)]
+        elif record_range is not None:
+            (start, _, stop) = record_range.partition(":")
+            try:
+                (start, stop, _) = slice(int(start) if start else None,
+                                         int(stop) if stop else None).indices(count)
+            except ValueError:
+                raise ProtopadError(
+                    f"Invalid range `{record_range}`. Use `start:stop`, like `10:20`.")
+            selections = [(start, stop)] if stop > start else []
+        else:
+            selections = [(number, number + 1) for (number, value)
+                          in enumerate(index.keys()) if value == key_value]
+        self.log(f"Converting {sum(stop - start for (start, stop) in selections)} "
+                 f"of {count} records.")
+
+        def records():
+            for (start, stop) in selections:
+                yield from read_indexed_records(infile, index.offsets(start, stop))
+
+        single = record is not None
+        mode = "w" if task == "json" else "wb"
+        with open_output_stream(outfile, mode) as outstream:
+            for data in _profiler.timed_records("read_input", records()):
+                base = parse_any_input(
+                    data, message_desc, internal_desc, input_format, fields)
+                if task == "json":
+                    with _profiler.stage("proto_to_json") as stage:
+                        result = proto_to_json(
+                            base, internal_desc, indent=2 if single else None)
+                        stage.nbytes = len(result)
+                    with _profiler.stage("write_output", len(result)):
+                        outstream.write(result)
+                        if not single or not outfile:
+                            outstream.write("\n")
+                else:
+                    with _profiler.stage("serialize") as stage:
+                        result = base.SerializeToString()
+                        stage.nbytes = len(result)
+                    with _profiler.stage("write_output", len(result)):
+                        if single:
+                            outstream.write(result)
+                        else:
+                            write_delimited_record(outstream, result)
+
+    # The index is rebuilt whenever the file's size or modification time has
+    # changed, or it doesn't have the key that's needed.
+    def open_record_index(self, filename, key_path=None, key_function=None):
+        index_path = filename + RECORD_INDEX_SUFFIX
+        stat = os.stat(filename)
+        index = read_record_index(index_path)
+        if (index is not None
+                and index.header["size"] == stat.st_size
+                and index.header["mtime_ns"] == stat.st_mtime_ns
+                and (key_path is None or index.header["key"] == key_path)):
+            return index
+
+        self.log(f"Indexing records in {filename}...")
+        try:
+            return build_record_index(filename, index_path, key_path, key_function)
+        except OSError as e:
+            raise ProtopadError(f"Could not write the record index {index_path}: {e}")
+
+    def convert_batch(self, task, type_name, internal_type_name, indir, outdir, jobs=None, input_format="auto", fields=None, internal_fields=None):
+        import multiprocessing
+        import time
+
+        relpaths = []
+        for (dirpath, _, filenames) in os.walk(indir):
+            for filename in filenames:
+                relpaths.append(os.path.relpath(
+                    os.path.join(dirpath, filename), indir))
+        relpaths.sort()
+
+        # Only the extension is replaced, so inputs like `a.json` and `a.bin`
+        # would be written to the same file.
+        inputs = {}
+        for relpath in relpaths:
+            inputs.setdefault(batch_output_relpath(relpath, task), []).append(relpath)
+        collisions = [paths for paths in inputs.values() if len(paths) > 1]
+        if collisions:
+            raise ProtopadError(
+                "Some input files would be written to the same output file: " +
+                "; ".join(", ".join(paths) for paths in collisions))
+
+        workers = jobs or os.cpu_count() or 1
+        chunksize = max(1, len(relpaths) // (workers * 4))
+        options = {
+            "task": task,
+            "type": type_name,
+            "internal_type": internal_type_name,
+            "internal_fields": internal_fields,
+            "indir": indir,
+            "outdir": outdir,
+            "input_format": input_format,
+            "fields": fields,
+            "verbose": self.verbose,
+            "profile": _profiler.enabled,
+        }
+        self.log(
+            f"Converting {len(relpaths)} files with {workers} workers...")
+
+        converted = 0
+        failures = 0
+        total_bytes = 0
+        start = time.perf_counter()
+        with multiprocessing.Pool(workers, init_batch_worker, (options,)) as pool:
+            results = pool.imap_unordered(
+                convert_batch_file, relpaths, chunksize)
+            for (relpath, size, error, stages) in results:
+                if stages:
+                    _profiler.merge(stages)
+                if error:
+                    failures += 1
+                    self.log(f"  Failed: {relpath}: {error}", always=True)
+                else:
+                    converted += 1
+                    total_bytes += size
+                    self.log(f"  Converted: {relpath}")
+        elapsed = max(time.perf_counter() - start, 1e-9)
+
+        self.log(f"Converted {converted} files ({failures} failed) in {elapsed:.2f}s: "
+                 f"{converted / elapsed:.1f} files/s, "
+                 f"{total_bytes / elapsed / 1e6:.2f} MB/s", always=True)
+        if failures:
+            raise ProtopadError(f"Failed to convert {failures} of {len(relpaths)} files.")
+
+    def serve(self, socket_path):
+        import asyncio
+
+        server = ProtopadServer(self, socket_path)
+        if asyncio.run(server.run()):
+            # Compiled definitions can't be replaced in a running process.
+            self.log("Proto definitions were recompiled. Restarting...", always=True)
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def convert_with_daemon(self, args):
+        # Incremental output would be built in full by the daemon, so it
+        # converts in-process to keep memory bounded.
+        if (args.get("no_daemon") or args.get("batch") or args.get("stream")
+                or args.get("incremental")
+                or args.get("record") is not None or args.get("range") or args.get("key")):
+            return False
+
+        # Connect before reading any input, so falling back can still read it.
+        sock = connect_to_daemon(SOCKET_PATH)
+        if sock is None:
+            return False
+        self.log(f"Converting with the daemon at {SOCKET_PATH}")
+
+        with sock:
+            with open_input_stream(args.get("file")) as instream:
+                payload = instream.read()
+            request = {
+                "task": args["task"],
+                "type": args["type"],
+                "internal_type": args.get("internal_type"),
+                "internal_fields": args.get("internal_field"),
+                "input_format": args.get("input_format", "auto"),
+                "fields": args.get("fields"),
+            }
+            with _profiler.stage("daemon_request", len(payload)):
+                result = request_daemon(sock, request, payload)
+
+        outfile = args.get("output")
         if outfile:
             with open(outfile, "wb") as f:
                 f.write(result)
+        elif args["task"] == "json":
+            print(result.decode())
         else:
             sys.stdout.buffer.write(result)
+        return True
 
     def edit_message(self, message_desc, internal_desc,
-                     infile, outfile, empty, recent, editor_command):
+                     infile, outfile, empty, recent, editor_command, input_format="auto",
+                     template_depth=TEMPLATE_MAX_DEPTH):
         filename = TEMPFILE_PATH if recent else infile
-        base = read_any_input(message_desc, internal_desc,
-                              filename) if filename else create_template_message(message_desc, empty)
+        if filename:
+            base = read_any_input(message_desc, internal_desc, filename, input_format)
+        elif empty:
+            base = create_template_message(message_desc, True)
+        else:
+            base = load_template_message(message_desc, template_depth)
+            fill_internal_templates(
+                base, get_internal_plan(message_desc, internal_desc), template_depth)
 
-        # TODO: Use create_template_message for empty binary entries.
         json = proto_to_json(base, internal_desc,
                              including_default_value_fields=True)
 
         self.log("Launching editor... (quit editor when finished)")
-        edited_json = interactive_edit_message(
-            json, editor_command=editor_command)
+        with _profiler.stage("editor"):
+            edited_json = interactive_edit_message(
+                json, editor_command=editor_command)
         self.log("Done.")
 
         resulting_message = json_to_proto(
@@ -194,8 +748,8 @@ class Protopad:
             if path in paths:
                 paths.remove(path)
             else:
-                fail(
-                    1, f"The path `{path}` is not registered and so can't be removed.")
+                raise ProtopadError(
+                    f"The path `{path}` is not registered and so can't be removed.")
         else:
             paths.add(path)
 
@@ -210,154 +764,1949 @@ class Protopad:
 
         self.recompile_protos()
 
-    def recompile_protos(self):
+    def set_compile_mode(self, compile_mode):
+        self.log(f"Setting compile mode: {compile_mode}")
+
+        with open(DOTFILE_PATH, "r") as f:
+            config = json.load(f)
+
+        config["compile_mode"] = compile_mode
+
+        with open(DOTFILE_PATH, "w") as f:
+            json.dump(config, f)
+
+        self.recompile_protos()
+
+    def recompile_protos(self, full=False):
+        with _profiler.stage("recompile_protos"):
+            self.compile_protos(full)
+
+    def compile_protos(self, full):
+        import concurrent.futures
+        import shutil
+
         self.log("Recompiling proto definitions...")
         with open(DOTFILE_PATH, "r") as f:
             config = json.load(f)
 
         paths = set(config.get("paths", []))
+        compile_mode = config.get("compile_mode", "python")
+
+        output_dir = COMPILED_PATH
+        manifest = read_compile_manifest()
+        if manifest and manifest.get("compile_mode", "python") != compile_mode:
+            self.log(f"  Compile mode changed to {compile_mode}")
+            full = True
+        if full:
+            shutil.rmtree(output_dir, ignore_errors=True)
+            manifest = {}
+        os.makedirs(output_dir, exist_ok=True)
+
+        previous_hashes = manifest.get("sources", {})
+        current_hashes = {path: hash_proto_sources(path) for path in paths}
+
+        for (path, hashes) in previous_hashes.items():
+            if compile_mode == "descriptor_set":
+                if path not in current_hashes:
+                    self.log(f"  Removing descriptors for unregistered path: {path}")
+                    remove_file(root_descriptor_set_path(output_dir, path))
+                continue
+            for relpath in hashes:
+                if relpath not in current_hashes.get(path, {}):
+                    self.log(f"  Removing module for deleted file: {relpath}")
+                    remove_file(compiled_module_path(output_dir, relpath))
+
+        # Files are only recorded once they are known to be up to date, so
+        # that failed files are retried next time.
+        jobs = []
+        compiled = {}
+        for (path, hashes) in current_hashes.items():
+            previous = previous_hashes.get(path, {})
+            if compile_mode == "descriptor_set":
+                # Each path is compiled into a single descriptor set, so a
+                # change to any of its files recompiles all of them.
+                unchanged = (previous == hashes and os.path.exists(
+                    root_descriptor_set_path(output_dir, path)))
+                compiled[path] = dict(hashes) if unchanged else {}
+            else:
+                compiled[path] = {
+                    relpath: digest for (relpath, digest) in hashes.items()
+                    if previous.get(relpath) == digest
+                    and os.path.exists(compiled_module_path(output_dir, relpath))}
+            changed = sorted(set(hashes) - set(compiled[path]))
+            self.log(
+                f"  {len(changed)} of {len(hashes)} files changed in {path}")
+            if compile_mode == "descriptor_set":
+                if changed:
+                    jobs.append((path, changed))
+            else:
+                jobs.extend((path, batch)
+                            for batch in batch_proto_files(changed))
 
-        output_dir = os.path.expanduser("~/.protopad/compiled")
-        shutil.rmtree(output_dir, ignore_errors=True)
-        os.makedirs(output_dir)
-
+        compile_job = (compile_descriptor_set if compile_mode == "descriptor_set"
+                       else compile_proto_batch)
         errors = []
-
-        for path in paths:
-            for (dirpath, _, filenames) in os.walk(path):
-                self.log(f"  Compiling modules in {dirpath}")
-                for filename in filenames:
-                    if os.path.splitext(filename)[1] == ".proto":
-                        filename = os.path.join(dirpath, filename)
-                        command = ["protoc", "-I", path,
-                                   "--python_out", output_dir, filename]
-                        command_string = " ".join(command)
-                        self.log(f"    Executing: {command_string}")
-
-                        output = subprocess.run(
-                            command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                        failed = output.returncode != 0
-                        if output.stdout:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            runs = pool.map(
+                lambda job: compile_job(job[0], job[1], output_dir), jobs)
+            for ((path, _), results) in zip(jobs, runs):
+                for (relpaths, command_string, returncode, stdout) in results:
+                    self.log(f"    Executing: {command_string}")
+                    failed = returncode != 0
+                    if not failed:
+                        for relpath in relpaths:
+                            compiled[path][relpath] = current_hashes[path][relpath]
+                    if stdout:
+                        if failed:
+                            message = f"    Failed: {command_string} {returncode}"
+                            errors.append(message)
+                            self.log(message)
+                        lines = stdout.decode().splitlines()
+                        for line in lines:
+                            message = f"      (protoc) {line}"
                             if failed:
-                                message = f"    Failed: {command_string} {output.returncode}"
                                 errors.append(message)
-                                self.log(message)
-                            lines = output.stdout.decode().splitlines()
-                            for line in lines:
-                                message = f"      (protoc) {line}"
-                                if failed:
-                                    errors.append(message)
-                                self.log(message)
+                            self.log(message)
+
+        if compile_mode == "descriptor_set":
+            merge_descriptor_sets(
+                [root_descriptor_set_path(output_dir, path)
+                 for path in sorted(paths)],
+                descriptor_set_path())
+
+        write_json_atomically(compile_manifest_path(), {
+            "compile_mode": compile_mode,
+            "sources": compiled,
+        })
 
         if errors:
-            eprint("  Compilation failed:")
-            for error in errors:
-                eprint(error)
-            fail(1, "protopad: Compilation failed for the above proto files.")
+            raise CompileError("\n".join(
+                ["Compilation failed for these proto files:"] + errors))
         else:
             self.log("Done.")
 
         self.log("")
-        self.generate_module_roots()
+        if compile_mode == "python":
+            self.generate_module_roots()
+            self.log("")
+        with _profiler.stage("build_type_index"):
+            self.build_type_index()
 
     def generate_module_roots(self):
         self.log("Generating module roots...")
         dirs = []
-        compiled_dir = os.path.expanduser("~/.protopad/compiled")
-        for (dirpath, _, _) in os.walk(compiled_dir):
-            self.log(f"  Creating module root in {dirpath}")
+        for (dirpath, _, _) in os.walk(COMPILED_PATH):
             rootpath = os.path.join(dirpath, "__init__.py")
+            # Top-level packages are left as namespace packages, so that they
+            # merge with installed packages of the same name (like `google`)
+            # instead of hiding them.
+            if os.path.dirname(dirpath) == COMPILED_PATH:
+                remove_file(rootpath)
+                continue
+            self.log(f"  Creating module root in {dirpath}")
             open(rootpath, "a").close()
         self.log("Done.")
 
 
-def read_any_input(message_desc, internal_desc, filename=None):
+def type_index_path():
+    return os.path.join(COMPILED_PATH, TYPE_INDEX_FILENAME)
+
+
+# A fingerprint of the compiled modules, used to detect a stale type index.
+def compiled_tree_stamp():
+    import hashlib
+
+    entries = []
+    for (dirpath, _, filenames) in os.walk(COMPILED_PATH):
+        for filename in filenames:
+            if filename.endswith("_pb2.py") or filename == DESCRIPTOR_SET_FILENAME:
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                relpath = os.path.relpath(path, COMPILED_PATH)
+                entries.append(f"{relpath}:{stat.st_size}:{stat.st_mtime_ns}")
+
+    entries.sort()
+    return hashlib.sha1("\n".join(entries).encode()).hexdigest()
+
+
+def import_compiled_module(module_name):
+    import importlib
+
+    # Generated modules import their dependencies relative to the compiled
+    # root. It goes last, so that it can't hide any installed packages.
+    if COMPILED_PATH not in sys.path:
+        sys.path.append(COMPILED_PATH)
+    return importlib.import_module(module_name)
+
+
+def compile_manifest_path():
+    return os.path.join(COMPILED_PATH, COMPILE_MANIFEST_FILENAME)
+
+
+def read_compile_manifest():
+    try:
+        with open(compile_manifest_path(), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def compiled_module_path(output_dir, relpath):
+    return os.path.join(output_dir, os.path.splitext(relpath)[0] + "_pb2.py")
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def descriptor_set_path():
+    return os.path.join(COMPILED_PATH, DESCRIPTOR_SET_FILENAME)
+
+
+def root_descriptor_set_path(output_dir, path):
+    import hashlib
+
+    name = hashlib.sha1(path.encode()).hexdigest() + ".pb"
+    return os.path.join(output_dir, DESCRIPTOR_SETS_DIRNAME, name)
+
+
+def read_descriptor_set(path):
+    from google.protobuf import descriptor_pb2
+
+    with open(path, "rb") as f:
+        return descriptor_pb2.FileDescriptorSet.FromString(f.read())
+
+
+# Files with the same name in different paths can't both be loaded, so only
+# the first one is kept.
+def merge_descriptor_sets(input_paths, output_path):
+    from google.protobuf import descriptor_pb2
+
+    merged = descriptor_pb2.FileDescriptorSet()
+    names = set()
+    for input_path in input_paths:
+        try:
+            file_set = read_descriptor_set(input_path)
+        except FileNotFoundError:
+            continue
+        for file_proto in file_set.file:
+            if file_proto.name not in names:
+                names.add(file_proto.name)
+                merged.file.add().CopyFrom(file_proto)
+
+    write_file_atomically(output_path, merged.SerializeToString())
+
+
+_descriptor_pools = {}
+
+
+# Builds the descriptor for a message type from the compiled descriptor set,
+# adding only the file it's defined in (and that file's imports) to the pool.
+def load_compiled_message_desc(file_name, full_name):
+    with cache_lock():
+        return find_compiled_message_desc(file_name, full_name)
+
+
+def find_compiled_message_desc(file_name, full_name):
+    from google.protobuf import descriptor_pool
+
+    path = descriptor_set_path()
+    stamp = os.stat(path).st_mtime_ns
+    cached = _descriptor_pools.get(path)
+    if cached is None or cached[0] != stamp:
+        file_set = read_descriptor_set(path)
+        files = {file_proto.name: file_proto for file_proto in file_set.file}
+        cached = _descriptor_pools[path] = (
+            stamp, descriptor_pool.DescriptorPool(), files)
+    (_, pool, files) = cached
+
+    def add_file(name):
+        try:
+            pool.FindFileByName(name)
+            return
+        except KeyError:
+            pass
+        if name not in files:
+            raise ProtopadError(f"Missing compiled descriptors for '{name}'")
+        for dependency in files[name].dependency:
+            add_file(dependency)
+        pool.AddSerializedFile(files[name].SerializeToString())
+
+    add_file(file_name)
+    return pool.FindMessageTypeByName(full_name)
+
+
+def hash_proto_sources(path):
+    import hashlib
+    import re
+
+    contents = {}
+    for (dirpath, _, filenames) in os.walk(path):
+        for filename in filenames:
+            if os.path.splitext(filename)[1] == ".proto":
+                filename = os.path.join(dirpath, filename)
+                with open(filename, "rb") as f:
+                    contents[os.path.relpath(filename, path)] = f.read()
+
+    # A file has to be recompiled when any file it imports (transitively) changes.
+    digests = {}
+
+    def digest(relpath, visiting):
+        if relpath in digests:
+            return digests[relpath]
+        visiting.add(relpath)
+        source = contents[relpath]
+        hasher = hashlib.sha256(source)
+        for match in sorted(set(re.findall(PROTO_IMPORT_PATTERN, source))):
+            imported = os.path.normpath(match.decode())
+            if imported in contents and imported not in visiting:
+                hasher.update(digest(imported, visiting).encode())
+        visiting.remove(relpath)
+        digests[relpath] = hasher.hexdigest()
+        return digests[relpath]
+
+    return {relpath: digest(relpath, set()) for relpath in contents}
+
+
+def batch_proto_files(relpaths):
+    workers = os.cpu_count() or 1
+    size = max(1, min(PROTOC_BATCH_SIZE, -(-len(relpaths) // workers)))
+    return [relpaths[i:i + size] for i in range(0, len(relpaths), size)]
+
+
+def compile_proto_batch(path, relpaths, output_dir):
+    import subprocess
+
+    def run(relpaths):
+        command = ["protoc", "-I", path, "--python_out", output_dir]
+        command += [os.path.join(path, relpath) for relpath in relpaths]
+        output = subprocess.run(
+            command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return (relpaths, " ".join(command), output.returncode, output.stdout)
+
+    result = run(relpaths)
+    if result[2] == 0 or len(relpaths) == 1:
+        return [result]
+
+    # Compile the failed batch file by file, to find out which ones are broken.
+    return [run([relpath]) for relpath in relpaths]
+
+
+def compile_descriptor_set(path, relpaths, output_dir):
+    import subprocess
+
+    output_path = root_descriptor_set_path(output_dir, path)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    def run(relpaths, output_path):
+        command = ["protoc", "-I", path, "--include_imports",
+                   "--descriptor_set_out", output_path]
+        command += [os.path.join(path, relpath) for relpath in relpaths]
+        output = subprocess.run(
+            command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return (relpaths, " ".join(command), output.returncode, output.stdout)
+
+    result = run(relpaths, output_path)
+    if result[2] == 0:
+        return [result]
+
+    # Compile the files one by one, and keep the ones that work.
+    results = []
+    file_set_paths = []
+    for (i, relpath) in enumerate(relpaths):
+        file_set_path = f"{output_path}.{i}"
+        result = run([relpath], file_set_path)
+        results.append(result)
+        if result[2] == 0:
+            file_set_paths.append(file_set_path)
+    merge_descriptor_sets(file_set_paths, output_path)
+    for file_set_path in file_set_paths:
+        os.remove(file_set_path)
+    return results
+
+
+# Record index files start with the magic bytes, then the length and contents
+# of a JSON header. Then come the offsets of every record and of the end of the
+# last one, as little-endian 64-bit integers. If the index has a key field, a
+# JSON list of every record's key value follows.
+class RecordIndex:
+    def __init__(self, path, header, offsets_start):
+        self.path = path
+        self.header = header
+        self.offsets_start = offsets_start
+
+    # Only the offsets that are needed are read.
+    def offsets(self, start, stop):
+        import array
+
+        offsets = array.array("Q")
+        with open(self.path, "rb") as f:
+            f.seek(self.offsets_start + offsets.itemsize * start)
+            offsets.fromfile(f, stop - start + 1)
+        if sys.byteorder == "big":
+            offsets.byteswap()
+        return offsets
+
+    def keys(self):
+        with open(self.path, "rb") as f:
+            f.seek(self.offsets_start + 8 * (self.header["count"] + 1))
+            return json.load(f)
+
+
+def read_record_index(path):
+    import struct
+
+    try:
+        with open(path, "rb") as f:
+            if f.read(len(RECORD_INDEX_MAGIC)) != RECORD_INDEX_MAGIC:
+                return None
+            (header_length,) = struct.unpack("<I", f.read(4))
+            header = json.loads(f.read(header_length))
+            return RecordIndex(path, header, f.tell())
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def build_record_index(filename, index_path, key_path=None, key_function=None):
+    import array
+    import mmap
+    import struct
+
+    stat = os.stat(filename)
+    offsets = array.array("Q")
+    keys = [] if key_path else None
+    with open(filename, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b""
+        try:
+            position = 0
+            while position < len(mapped):
+                offsets.append(position)
+                (length, start) = decode_varint(mapped, position)
+                position = start + length
+                if position > len(mapped):
+                    raise InvalidInputError(
+                        f"Record {len(offsets) - 1} is truncated: expected {length} bytes but found {len(mapped) - start}.")
+                if keys is not None:
+                    keys.append(key_function(mapped[start:position]))
+            offsets.append(position)
+        finally:
+            if stat.st_size:
+                mapped.close()
+
+    header = json.dumps({
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "count": len(offsets) - 1,
+        "key": key_path,
+    }).encode()
+    if sys.byteorder == "big":
+        offsets.byteswap()
+    data = [RECORD_INDEX_MAGIC, struct.pack("<I", len(header)), header, offsets.tobytes()]
+    if keys is not None:
+        data.append(json.dumps(keys).encode())
+    write_file_atomically(index_path, b"".join(data))
+    return read_record_index(index_path)
+
+
+# Reads the records between the given offsets, only mapping those bytes.
+def read_indexed_records(filename, offsets):
+    import mmap
+
+    (start, end) = (offsets[0], offsets[-1])
+    if end <= start:
+        return
+    with open(filename, "rb") as f:
+        aligned = start - start % mmap.ALLOCATIONGRANULARITY
+        with mmap.mmap(f.fileno(), end - aligned, access=mmap.ACCESS_READ, offset=aligned) as mapped:
+            for record_start in offsets[:-1]:
+                (length, position) = decode_varint(mapped, record_start - aligned)
+                yield mapped[position:position + length]
+
+
+def write_json_atomically(path, data):
+    write_file_atomically(path, json.dumps(data).encode())
+
+
+def write_file_atomically(path, data):
+    import threading
+
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def read_any_input(message_desc, internal_desc, filename=None, input_format="auto", fields=None):
+    with open_input_buffer(filename) as data:
+        return parse_any_input(data, message_desc, internal_desc, input_format, fields)
+
+
+# The pure-Python backend can parse straight from a buffer, so files are
+# memory-mapped for it instead of being copied into memory first. The native
+# backends copy any buffer into bytes before parsing, so mapping the file
+# would only add a copy for them.
+@contextlib.contextmanager
+def open_input_buffer(filename=None):
+    with contextlib.ExitStack() as stack:
+        with _profiler.stage("read_input") as stage:
+            data = stack.enter_context(read_input_buffer(filename))
+            stage.nbytes = len(data)
+        yield data
+
+
+@contextlib.contextmanager
+def read_input_buffer(filename=None):
+    import mmap
+
+    if not filename:
+        yield sys.stdin.buffer.read()
+        return
+
+    with open(filename, "rb") as f:
+        if protobuf_backend() != "python":
+            yield f.read()
+            return
+
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Empty files and pipes can't be mapped.
+            yield f.read()
+            return
+
+        view = memoryview(mapped)
+        try:
+            yield view
+        except BaseException:
+            # The traceback can still reference slices of the view, which
+            # stop the map from being closed, so it's left to be collected.
+            raise
+        view.release()
+        mapped.close()
+
+
+# Batch conversions run in worker processes, which each resolve the message
+# types once when they start.
+_batch_worker = {}
+
+
+def init_batch_worker(options):
+    # Workers collect their own stage timings, which are merged by the parent.
+    _profiler.detach(options["profile"])
+    app = Protopad(options["verbose"])
+    _batch_worker.update(options)
+    _batch_worker["message_desc"] = app.get_message_desc(options["type"])
+    _batch_worker["internal_desc"] = resolve_internal_types(
+        app.get_message_desc, _batch_worker["message_desc"],
+        options["internal_type"], options["internal_fields"])
+    fields = options["fields"]
+    _batch_worker["field_selection"] = select_fields(
+        fields, _batch_worker["message_desc"], _batch_worker["internal_desc"]) if fields else None
+
+
+def batch_output_relpath(relpath, task):
+    extension = ".json" if task == "json" else ".bin"
+    return os.path.splitext(relpath)[0] + extension
+
+
+def convert_batch_file(relpath):
+    worker = _batch_worker
+    message_desc = worker["message_desc"]
+    internal_desc = worker["internal_desc"]
+    try:
+        with open_input_buffer(os.path.join(worker["indir"], relpath)) as data:
+            size = len(data)
+            base = parse_any_input(
+                data, message_desc, internal_desc, worker["input_format"],
+                worker["field_selection"])
+
+        if worker["task"] == "json":
+            with _profiler.stage("proto_to_json") as stage:
+                result = proto_to_json(base, internal_desc).encode()
+                stage.nbytes = len(result)
+        else:
+            with _profiler.stage("serialize") as stage:
+                result = base.SerializeToString()
+                stage.nbytes = len(result)
+
+        outfile = os.path.join(
+            worker["outdir"], batch_output_relpath(relpath, worker["task"]))
+        with _profiler.stage("write_output", len(result)):
+            os.makedirs(os.path.dirname(outfile), exist_ok=True)
+            with open(outfile, "wb") as f:
+                f.write(result)
+        return (relpath, size, None, _profiler.take())
+    except (ProtopadError, OSError) as e:
+        return (relpath, 0, str(e), _profiler.take())
+
+
+# Converts messages of one type in-process, for using protopad as a library.
+# The message types and field selection are resolved once, when it's
+# created, and a converter can be shared between threads. Types can be given
+# by name (like on the command line) or as descriptors.
+class Converter:
+    def __init__(self, message_type, internal_type=None, internal_fields=None,
+                 fields=None, input_format="auto", get_message_desc=None):
+        if get_message_desc is None:
+            get_message_desc = Protopad().get_message_desc
+
+        def resolve(message_type):
+            if isinstance(message_type, str):
+                return get_message_desc(message_type)
+            return message_type
+
+        self.message_desc = resolve(message_type)
+        self.internal_desc = resolve_internal_types(
+            resolve, self.message_desc, internal_type, internal_fields)
+        self.field_selection = select_fields(
+            fields, self.message_desc, self.internal_desc) if fields else None
+        self.input_format = input_format
+
+    def parse(self, data):
+        return parse_any_input(data, self.message_desc, self.internal_desc,
+                               self.input_format, self.field_selection)
+
+    def to_json(self, data, indent=2):
+        return proto_to_json(self.parse(data), self.internal_desc, indent=indent)
+
+    def to_binary(self, data):
+        return self.parse(data).SerializeToString()
+
+    def to_json_batch(self, payloads, indent=None):
+        return [self.to_json(data, indent) for data in payloads]
+
+    def to_binary_batch(self, payloads):
+        return [self.to_binary(data) for data in payloads]
+
+
+class ProtopadServer:
+    poll_interval = 1.0
+
+    def __init__(self, app, socket_path):
+        self.app = app
+        self.socket_path = socket_path
+        self.descs = {}
+        self.connections = 0
+
+    # Requests are converted on the executor's threads, so the descriptors
+    # are cached under the same lock as the other shared caches.
+    def get_message_desc(self, type_name):
+        with cache_lock():
+            if type_name not in self.descs:
+                self.descs[type_name] = self.app.get_message_desc(type_name)
+            return self.descs[type_name]
+
+    def convert(self, request, payload):
+        converter = Converter(
+            request["type"], request.get("internal_type"), request.get("internal_fields"),
+            request.get("fields"), request.get("input_format", "auto"), self.get_message_desc)
+        if request["task"] == "json":
+            return converter.to_json(payload).encode()
+        elif request["task"] == "proto":
+            return converter.to_binary(payload)
+        else:
+            raise ProtopadError(f"Unknown task '{request['task']}'")
+
+    # Requests and responses are a line of JSON, followed by a payload of the
+    # length given in that JSON. A connection may send any number of requests.
+    async def handle_client(self, reader, writer):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        self.connections += 1
+        try:
+            while True:
+                header = await reader.readline()
+                if not header:
+                    break
+                try:
+                    request = json.loads(header)
+                    payload = await reader.readexactly(request["length"])
+                    result = await loop.run_in_executor(
+                        None, self.convert, request, payload)
+                    response = {"status": "ok", "length": len(result)}
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    raise
+                # Any other failure only fails this request.
+                except Exception as e:
+                    message = str(e) if isinstance(e, ProtopadError) else f"{type(e).__name__}: {e}"
+                    self.app.log(f"Request failed: {message}")
+                    (response, result) = (
+                        {"status": "error", "message": message, "length": 0}, b"")
+                writer.write(json.dumps(response).encode() + b"\n" + result)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    def index_mtime(self):
+        try:
+            return os.stat(type_index_path()).st_mtime_ns
+        except OSError:
+            return None
+
+    async def wait_for_recompile(self):
+        import asyncio
+
+        initial_mtime = self.index_mtime()
+        while self.index_mtime() == initial_mtime:
+            await asyncio.sleep(self.poll_interval)
+
+    # Serves until the proto definitions are recompiled, then returns True
+    # once the open connections are finished.
+    async def run(self):
+        import asyncio
+
+        sock = connect_to_daemon(self.socket_path)
+        if sock is not None:
+            sock.close()
+            raise ProtopadError(
+                f"A protopad daemon is already listening on {self.socket_path}")
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+        self.app.log(f"Listening on {self.socket_path}", always=True)
+        try:
+            async with server:
+                await self.wait_for_recompile()
+        finally:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+        while self.connections:
+            await asyncio.sleep(0.01)
+        return True
+
+
+def connect_to_daemon(socket_path):
+    import socket
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def request_daemon(sock, request, payload):
+    header = json.dumps(dict(request, length=len(payload))).encode()
+    sock.sendall(header + b"\n" + payload)
+
+    with sock.makefile("rb") as response_stream:
+        response_line = response_stream.readline()
+        if not response_line:
+            raise ProtopadError("The protopad daemon closed the connection.")
+        response = json.loads(response_line)
+        result = response_stream.read(response["length"])
+
+    if response["status"] != "ok":
+        raise ProtopadError(response["message"])
+    return result
+
+
+@contextlib.contextmanager
+def open_input_stream(filename=None):
     if filename:
         with open(filename, "rb") as f:
-            data = f.read()
+            yield f
+    else:
+        yield sys.stdin.buffer
+
+
+@contextlib.contextmanager
+def open_output_stream(filename, mode):
+    if filename:
+        with open(filename, mode) as f:
+            yield f
+    else:
+        stream = sys.stdout.buffer if "b" in mode else sys.stdout
+        yield stream
+        stream.flush()
+
+
+def read_records(stream, framing):
+    if framing == "delimited":
+        records = read_delimited_records(stream)
+    elif framing == "lines":
+        records = read_line_records(stream)
     else:
-        data = sys.stdin.buffer.read()
+        assert False, "Unreachable code!"
+    return _profiler.timed_records("read_input", records)
+
+
+def read_delimited_records(stream):
+    index = 0
+    while True:
+        length = read_varint(stream)
+        if length is None:
+            return
+        record = stream.read(length)
+        if len(record) != length:
+            raise InvalidInputError(
+                f"Record {index} is truncated: expected {length} bytes but found {len(record)}.")
+        yield record
+        index += 1
+
+
+def read_line_records(stream):
+    for line in stream:
+        if line.strip():
+            yield line
+
+
+def read_varint(stream):
+    result = 0
+    shift = 0
+    while True:
+        byte = stream.read(1)
+        if not byte:
+            if shift == 0:
+                return None
+            raise InvalidInputError(
+                "Input ended in the middle of a record length prefix.")
+        result |= (byte[0] & 0x7f) << shift
+        if not byte[0] & 0x80:
+            return result
+        shift += 7
+
+
+def encode_varint(value):
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def write_delimited_record(stream, record):
+    stream.write(encode_varint(len(record)))
+    stream.write(record)
+
+
+# Resolves a path of field names (like `a.b.c`) to its fields. Each step is
+# the field, and the internal type that it holds (if any), which the path
+# continues into.
+def resolve_field_path(path, message_desc, internal_desc):
+    desc = message_desc
+    plan = get_internal_plan(message_desc, internal_desc)
+    steps = []
+    names = path.split(".")
+    for (i, name) in enumerate(names):
+        field = find_field(desc, name)
+        if field is None:
+            raise ProtopadError(
+                f"Unknown field '{name}' in `{path}` for the message type `{desc.name}`")
+
+        internal_fields = {field_name: (field_desc, field_plan)
+                           for (field_name, _, field_desc, field_plan)
+                           in plan.bytes_fields} if plan else {}
+        field_plans = {field_name: field_plan for (field_name, _, field_plan)
+                       in plan.message_fields} if plan else {}
+        if i == len(names) - 1:
+            steps.append((field, None))
+        elif field.name in internal_fields:
+            (desc, plan) = internal_fields[field.name]
+            steps.append((field, desc))
+        elif field.message_type and not field.message_type.GetOptions().map_entry:
+            (desc, plan) = (field.message_type, field_plans.get(field.name))
+            steps.append((field, None))
+        else:
+            raise ProtopadError(
+                f"The field `{field.name}` in `{path}` doesn't have fields to select")
+    return steps
+
+
+# Resolves `--fields` paths (like `a.b,c`) to a tree of field numbers, where
+# None selects a whole field. Paths can continue into internal messages.
+def select_fields(paths, message_desc, internal_desc):
+    selection = {}
+    for path in paths.split(","):
+        target = selection
+        steps = resolve_field_path(path, message_desc, internal_desc)
+        for (i, (field, _)) in enumerate(steps):
+            if i == len(steps) - 1 or target.get(field.number, {}) is None:
+                target[field.number] = None
+                break
+            target = target.setdefault(field.number, {})
+    return selection
+
+
+# Copies only the selected fields of a binary message, without decoding the
+# rest: unselected fields are skipped over using their lengths.
+def prune_fields(data, selection):
+    view = memoryview(data)
+    output = bytearray()
+    position = 0
+    while position < len(view):
+        start = position
+        (tag, position) = decode_varint(view, position)
+        (field_number, wire_type) = (tag >> 3, tag & 7)
+        value_start = position
+        position = skip_field(view, position, field_number, wire_type)
+
+        if field_number not in selection:
+            continue
+        field_selection = selection[field_number]
+        if field_selection is None or wire_type != 2:
+            output += view[start:position]
+            continue
+
+        (_, payload_start) = decode_varint(view, value_start)
+        pruned = prune_fields(view[payload_start:position], field_selection)
+        output += view[start:value_start]
+        output += encode_varint(len(pruned))
+        output += pruned
+    return bytes(output)
+
+
+def skip_field(view, position, field_number, wire_type):
+    if wire_type == 0:
+        (_, position) = decode_varint(view, position)
+    elif wire_type == 1:
+        position += 8
+    elif wire_type == 2:
+        (length, position) = decode_varint(view, position)
+        position += length
+    elif wire_type == 3:
+        # Groups end with a matching end-group tag.
+        while True:
+            (tag, position) = decode_varint(view, position)
+            if tag == (field_number << 3) | 4:
+                break
+            position = skip_field(view, position, tag >> 3, tag & 7)
+    elif wire_type == 5:
+        position += 4
+    else:
+        raise InvalidInputError(
+            f"Failed to decode input: invalid wire type {wire_type} for field {field_number}.")
+
+    if position > len(view):
+        raise InvalidInputError(
+            f"Failed to decode input: field {field_number} is truncated.")
+    return position
+
+
+def decode_varint(view, position):
+    result = 0
+    shift = 0
+    while True:
+        if position >= len(view):
+            raise InvalidInputError("Failed to decode input: a varint is truncated.")
+        byte = view[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return (result, position)
+        shift += 7
+
+
+CONDITION_PATTERN = r"^\s*([\w.]+)\s*(==|=|!=|<=|>=|<|>|~)\s*(.*?)\s*$"
+PRESENCE_PATTERN = r"^\s*(!?)\s*([\w.]+)\s*$"
+
+
+# A `--where` condition of the `query` command, like `a.b == 5`, `name ~ regex`
+# or `a.b` (the field is set). Repeated fields match if any of their values do.
+class QueryCondition:
+    def __init__(self, expression, message_desc, internal_desc):
+        import re
+        from google.protobuf.descriptor import FieldDescriptor
+
+        presence = re.match(PRESENCE_PATTERN, expression)
+        comparison = re.match(CONDITION_PATTERN, expression)
+        if presence:
+            (negated, self.path) = presence.groups()
+            self.operator = "!" if negated else "?"
+        elif comparison:
+            (self.path, self.operator, text) = comparison.groups()
+        else:
+            raise ProtopadError(
+                f"Invalid condition `{expression}`. Use `path`, `!path`, or `path OP value` "
+                "with one of the operators ==, !=, <, <=, >, >= or ~ (a regular expression).")
+
+        self.steps = resolve_field_path(self.path, message_desc, internal_desc)
+        (field, _) = self.steps[-1]
+        if self.operator in ("?", "!"):
+            self.value = None
+        elif self.operator == "~":
+            if field.cpp_type != FieldDescriptor.CPPTYPE_STRING:
+                raise ProtopadError(
+                    f"The field `{field.name}` isn't a string, so it can't be matched with `~`")
+            pattern = unquote(text)
+            self.value = re.compile(
+                pattern.encode() if field.type == FieldDescriptor.TYPE_BYTES else pattern)
+        else:
+            self.value = parse_field_value(field, unquote(text))
+
+    def matches(self, message):
+        import operator
+
+        if self.operator in ("?", "!"):
+            present = bool(field_path_values(message, self.steps))
+            return present if self.operator == "?" else not present
+
+        # Comparisons see the values of scalar fields, even if they're defaults.
+        values = field_path_values(message, self.steps, defaults=True)
+        if self.operator == "~":
+            return any(self.value.search(value) for value in values)
 
-    return parse_any_input(data, message_desc, internal_desc)
+        compare = {
+            "=": operator.eq, "==": operator.eq, "!=": operator.ne,
+            "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge,
+        }[self.operator]
+        return any(compare(value, self.value) for value in values)
+
+
+def unquote(text):
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in "\"'":
+        return text[1:-1]
+    return text
+
+
+def parse_field_value(field, text):
+    from google.protobuf.descriptor import FieldDescriptor
+
+    if field.message_type:
+        raise ProtopadError(
+            f"The field `{field.name}` is a message, so it can only be tested for presence")
+
+    try:
+        if field.cpp_type in (FieldDescriptor.CPPTYPE_INT32, FieldDescriptor.CPPTYPE_INT64,
+                              FieldDescriptor.CPPTYPE_UINT32, FieldDescriptor.CPPTYPE_UINT64):
+            return int(text, 0)
+        elif field.cpp_type in (FieldDescriptor.CPPTYPE_FLOAT, FieldDescriptor.CPPTYPE_DOUBLE):
+            return float(text)
+        elif field.cpp_type == FieldDescriptor.CPPTYPE_BOOL:
+            return {"true": True, "false": False}[text.lower()]
+        elif field.cpp_type == FieldDescriptor.CPPTYPE_ENUM:
+            if text.lstrip("-").isdigit():
+                return int(text)
+            return field.enum_type.values_by_name[text].number
+        elif field.type == FieldDescriptor.TYPE_BYTES:
+            return text.encode()
+        else:
+            return text
+    except (ValueError, KeyError):
+        raise ProtopadError(
+            f"Invalid value `{text}` for the field `{field.name}`")
+
+
+# The values at the end of a path, following every element of repeated
+# fields. Fields that aren't set have no values, unless `defaults` is set:
+# then a scalar field at the end of the path always has its value, even if
+# it's the default.
+def field_path_values(message, steps, defaults=False):
+    values = [message]
+    for (i, (field, internal_desc)) in enumerate(steps):
+        last_scalar = defaults and i == len(steps) - 1 and not field.message_type
+        next_values = []
+        for value in values:
+            if is_repeated(field):
+                next_values.extend(getattr(value, field.name))
+            elif last_scalar or has_field_value(value, field):
+                next_values.append(getattr(value, field.name))
+        if internal_desc is not None:
+            internal_values = []
+            for value in next_values:
+                internal_message = message_class(internal_desc)()
+                parse_proto_or_fail(internal_message, value,
+                                    f"Failed to decode internal type as {internal_desc.name}.")
+                internal_values.append(internal_message)
+            next_values = internal_values
+        values = next_values
+    return values
 
 
-def parse_any_input(data, message_desc, internal_desc):
+def has_field_value(message, field):
     try:
-        json = data.decode("utf-8")
-        return json_to_proto(json, message_desc, internal_desc)
-    except:
-        base = message_desc._concrete_class()
+        return message.HasField(field.name)
+    except ValueError:
+        # Fields without presence are only set if they aren't the default.
+        return getattr(message, field.name) != field.default_value
+
+
+_message_factories = {}
+
+
+# Flattens a message type into columns, one for every scalar field reachable
+# through message fields (and internal messages). Fields inside repeated
+# fields become list columns, except inside the field given by `explode`,
+# whose elements each get a row of their own. Messages where that field is
+# empty get no rows, since the columns have no null values. Maps, well-known
+# types and recursive fields are kept whole, as JSON.
+class ExportPlan:
+    def __init__(self, message_desc, internal_desc, fields=None, explode=None):
+        self.selected = [tuple(field.name for (field, _) in resolve_field_path(
+            path, message_desc, internal_desc)) for path in fields.split(",")] if fields else None
+        self.explode = None
+        if explode:
+            steps = resolve_field_path(explode, message_desc, internal_desc)
+            if (not is_repeated(steps[-1][0]) or is_map(steps[-1][0])
+                    or any(is_repeated(field) for (field, _) in steps[:-1])):
+                raise ProtopadError(
+                    f"The field `{explode}` can't be exploded: it must be a repeated field (not a map), and not inside another one")
+            self.explode = tuple(field.name for (field, _) in steps)
+
+        self.columns = []
+        self.entries = self.build(
+            message_desc, get_internal_plan(message_desc, internal_desc),
+            (), False, frozenset([message_desc]))
+        if not self.columns:
+            raise ProtopadError(f"The message type `{message_desc.name}` has no fields to export")
+
+    def is_selected(self, path):
+        return self.selected is None or any(
+            selected[:len(path)] == path or path[:len(selected)] == selected
+            for selected in self.selected)
+
+    # Each entry is (field, internal type, child entries, column, exploded).
+    def build(self, desc, plan, path, listed, ancestors):
+        internal_fields = {field_name: (field_desc, field_plan)
+                           for (field_name, _, field_desc, field_plan)
+                           in plan.bytes_fields} if plan else {}
+        field_plans = {field_name: field_plan for (field_name, _, field_plan)
+                       in plan.message_fields} if plan else {}
+
+        entries = []
+        for field in desc.fields:
+            field_path = path + (field.name,)
+            if not self.is_selected(field_path):
+                continue
+            exploded = field_path == self.explode
+            field_listed = listed or (is_repeated(field) and not is_map(field) and not exploded)
+            message_type = field.message_type
+            if field.name in internal_fields:
+                (field_desc, field_plan) = internal_fields[field.name]
+                entries.append((field, field_desc, self.build(
+                    field_desc, field_plan, field_path, field_listed, ancestors | {field_desc}),
+                    None, exploded))
+            elif (message_type and not is_map(field)
+                    and message_type.full_name not in JSON_SPECIAL_TYPES
+                    and message_type not in ancestors):
+                entries.append((field, None, self.build(
+                    message_type, field_plans.get(field.name), field_path, field_listed,
+                    ancestors | {message_type}), None, exploded))
+            else:
+                column = ExportColumn(".".join(field_path), field, field_listed)
+                column.index = len(self.columns)
+                self.columns.append(column)
+                entries.append((field, None, None, column, exploded))
+        return entries
+
+    # Returns the values of every column, for each row of the message.
+    def extract(self, message):
+        values = [None] * len(self.columns)
+        exploded = self.collect(self.entries, [message], values)
+        if exploded is None:
+            return [values]
+
+        (entry, items) = exploded
+        (_, _, children, column, _) = entry
+        rows = []
+        for item in items:
+            row = list(values)
+            if children is None:
+                row[column.index] = column.convert(item)
+            else:
+                self.collect(children, [item], row)
+            rows.append(row)
+        return rows
+
+    # The messages are those at this level: one, unless the fields are inside
+    # a repeated field. Then all of their values go in list columns.
+    def collect(self, entries, messages, values):
+        exploded = None
+        for entry in entries:
+            (field, internal_desc, children, column, is_exploded) = entry
+            if is_exploded:
+                exploded = (entry, getattr(messages[0], field.name))
+                continue
+
+            items = []
+            for message in messages:
+                if is_repeated(field) and children is not None:
+                    items.extend(getattr(message, field.name))
+                else:
+                    items.append(getattr(message, field.name))
+            if internal_desc is not None:
+                decoded = []
+                for item in items:
+                    internal_message = message_class(internal_desc)()
+                    parse_proto_or_fail(internal_message, item,
+                                        f"Failed to decode internal type as {internal_desc.name}.")
+                    decoded.append(internal_message)
+                items = decoded
+
+            if children is not None:
+                exploded = self.collect(children, items, values) or exploded
+            elif column.listed:
+                values[column.index] = [
+                    column.convert(value) for item in items
+                    for value in (item if column.repeated else [item])]
+            else:
+                values[column.index] = column.convert(items[0])
+        return exploded
+
+
+class ExportColumn:
+    def __init__(self, name, field, listed):
+        from google.protobuf.descriptor import FieldDescriptor
+
+        self.name = name
+        self.field = field
+        self.listed = listed
+        # Maps are kept whole, as JSON objects.
+        self.repeated = is_repeated(field) and not is_map(field)
+        if field.message_type:
+            self.kind = "json"
+        elif field.cpp_type == FieldDescriptor.CPPTYPE_ENUM:
+            self.kind = "enum"
+        elif field.type == FieldDescriptor.TYPE_BYTES:
+            self.kind = "bytes"
+        elif field.cpp_type == FieldDescriptor.CPPTYPE_STRING:
+            self.kind = "string"
+        else:
+            self.kind = {
+                FieldDescriptor.CPPTYPE_INT32: "int32",
+                FieldDescriptor.CPPTYPE_INT64: "int64",
+                FieldDescriptor.CPPTYPE_UINT32: "uint32",
+                FieldDescriptor.CPPTYPE_UINT64: "uint64",
+                FieldDescriptor.CPPTYPE_FLOAT: "float",
+                FieldDescriptor.CPPTYPE_DOUBLE: "double",
+                FieldDescriptor.CPPTYPE_BOOL: "bool",
+            }[field.cpp_type]
+        # Numeric columns are collected straight into typed arrays.
+        self.typecode = None if listed else EXPORT_TYPECODES.get(self.kind)
+
+    # Converts a field value to the value stored in the column.
+    def convert(self, value):
+        json_format = protobuf_module("json_format")
+
+        if self.kind == "enum":
+            enum_value = self.field.enum_type.values_by_number.get(value)
+            return enum_value.name if enum_value is not None else str(value)
+        elif self.kind != "json":
+            return value
+        elif is_map(self.field):
+            value_field = self.field.message_type.fields_by_name["value"]
+            return {scalar_to_json(self.field.message_type.fields_by_name["key"], key):
+                    json_format.MessageToDict(item) if value_field.message_type
+                    else scalar_to_json(value_field, item)
+                    for (key, item) in value.items()}
+        return json_format.MessageToDict(value)
+
+    # The value as it would appear in JSON, for text formats.
+    def to_json(self, value):
+        if self.kind == "bool":
+            return bool(value)
+        elif self.kind == "bytes":
+            return base64.b64encode(value).decode("utf-8")
+        elif self.kind in ("float", "double"):
+            return scalar_to_json(self.field, value)
+        return value
+
+    def to_text(self, value):
+        if self.listed:
+            return json.dumps([self.to_json(item) for item in value])
+        value = self.to_json(value)
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        elif self.kind == "json" and not isinstance(value, str):
+            return json.dumps(value)
+        return value
+
+
+EXPORT_TYPECODES = {
+    "int32": "i", "int64": "q", "uint32": "I", "uint64": "Q",
+    "float": "f", "double": "d", "bool": "B",
+}
+
+
+# The values of a batch of rows, by column.
+class ExportBatch:
+    def __init__(self, columns):
+        import array
+
+        self.count = 0
+        self.values = [array.array(column.typecode) if column.typecode else []
+                       for column in columns]
+
+    def add(self, row):
+        self.count += 1
+        for (values, value) in zip(self.values, row):
+            values.append(value)
+
+
+class CsvExportWriter:
+    def __init__(self, stream, columns):
+        import csv
+
+        self.columns = columns
+        self.writer = csv.writer(stream, lineterminator="\n")
+        self.writer.writerow([column.name for column in columns])
+
+    def write_batch(self, batch):
+        columns = [[column.to_text(value) for value in values]
+                   for (column, values) in zip(self.columns, batch.values)]
+        self.writer.writerows(zip(*columns))
+
+    def close(self):
+        pass
+
+
+class ParquetExportWriter:
+    def __init__(self, path, columns):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ProtopadError(
+                "Exporting to Parquet needs the pyarrow package (`pip install pyarrow`).")
+
+        self.pyarrow = pyarrow
+        self.columns = columns
+        types = {
+            "int32": pyarrow.int32(), "int64": pyarrow.int64(),
+            "uint32": pyarrow.uint32(), "uint64": pyarrow.uint64(),
+            "float": pyarrow.float32(), "double": pyarrow.float64(),
+            "bool": pyarrow.bool_(), "bytes": pyarrow.binary(),
+        }
+        self.types = []
+        for column in columns:
+            column_type = types.get(column.kind, pyarrow.string())
+            self.types.append(pyarrow.list_(column_type) if column.listed else column_type)
+        self.schema = pyarrow.schema(
+            [(column.name, column_type) for (column, column_type) in zip(columns, self.types)])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write_batch(self, batch):
+        pyarrow = self.pyarrow
+        arrays = []
+        for (column, column_type, values) in zip(self.columns, self.types, batch.values):
+            if column.typecode == "B":
+                buffers = [None, pyarrow.py_buffer(values)]
+                array = pyarrow.Array.from_buffers(pyarrow.uint8(), len(values), buffers)
+                arrays.append(array.cast(pyarrow.bool_()))
+            elif column.typecode:
+                buffers = [None, pyarrow.py_buffer(values)]
+                arrays.append(pyarrow.Array.from_buffers(column_type, len(values), buffers))
+            elif column.kind == "json" and column.listed:
+                arrays.append(pyarrow.array([[json_text(item) for item in items]
+                                             for items in values], column_type))
+            elif column.kind == "json":
+                arrays.append(pyarrow.array([json_text(value) for value in values], column_type))
+            else:
+                arrays.append(pyarrow.array(values, column_type))
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+# NumPy arrays have a fixed size, so the batches are kept until the end. List
+# and JSON columns are stored as JSON text, and bytes as base64 like in CSV,
+# because NumPy's fixed-size bytes drop trailing NUL bytes.
+class NpyExportWriter:
+    def __init__(self, path, columns):
+        try:
+            import numpy
+        except ImportError:
+            raise ProtopadError(
+                "Exporting to NumPy arrays needs the numpy package (`pip install numpy`).")
+
+        self.numpy = numpy
+        self.path = path
+        self.columns = columns
+        self.batch = ExportBatch(columns)
+
+    def write_batch(self, batch):
+        self.batch.count += batch.count
+        for (column, values, batch_values) in zip(self.columns, self.batch.values, batch.values):
+            if column.typecode or (not column.listed and column.kind in ("string", "enum")):
+                values.extend(batch_values)
+            else:
+                values.extend(column.to_text(value) for value in batch_values)
+
+    def close(self):
+        numpy = self.numpy
+        fields = []
+        for (column, values) in zip(self.columns, self.batch.values):
+            if column.typecode == "B":
+                fields.append((column.name, numpy.bool_))
+            elif column.typecode:
+                fields.append((column.name, numpy.dtype(column.typecode)))
+            else:
+                fields.append((column.name, f"U{max(map(len, values), default=0) or 1}"))
+
+        array = numpy.zeros(self.batch.count, dtype=fields)
+        for (column, values) in zip(self.columns, self.batch.values):
+            if column.typecode == "B":
+                array[column.name] = numpy.frombuffer(values, numpy.uint8).astype(numpy.bool_)
+            elif column.typecode:
+                array[column.name] = numpy.frombuffer(values, column.typecode)
+            else:
+                array[column.name] = values
+        numpy.save(self.path, array, allow_pickle=False)
+
+
+def json_text(value):
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+# Newer protobuf versions create message classes through the factory, which
+# works for every backend and for descriptors from any pool.
+def message_class(message_desc):
+    message_factory = protobuf_module("message_factory")
+    if hasattr(message_factory, "GetMessageClass"):
+        return message_factory.GetMessageClass(message_desc)
+
+    # Older versions only attach classes to generated descriptors.
+    pool = message_desc.file.pool
+    if pool is protobuf_module("descriptor_pool").Default():
+        return message_desc._concrete_class
+    with cache_lock():
+        if pool not in _message_factories:
+            _message_factories[pool] = message_factory.MessageFactory(pool)
+        return _message_factories[pool].GetPrototype(message_desc)
+
+
+# protobuf 26 renamed `including_default_value_fields`.
+def json_printing_options(including_default_value_fields):
+    json_format = protobuf_module("json_format")
+
+    if "including_default_value_fields" in json_format.MessageToDict.__code__.co_varnames:
+        return {"including_default_value_fields": including_default_value_fields}
+    return {"always_print_fields_with_no_presence": including_default_value_fields}
+
+
+def is_map(field):
+    return field.message_type is not None and field.message_type.GetOptions().map_entry
+
+
+# protobuf 6 replaced `FieldDescriptor.label` with `is_repeated`.
+def is_repeated(field):
+    if hasattr(field, "is_repeated"):
+        return field.is_repeated
+    return field.label == protobuf_module("descriptor").FieldDescriptor.LABEL_REPEATED
+
+
+def protobuf_backend():
+    return protobuf_module("internal.api_implementation").Type()
+
+
+def parse_any_input(data, message_desc, internal_desc, input_format="auto", fields=None):
+    json_format = protobuf_module("json_format")
+
+    fallback = input_format == "auto"
+    if fallback:
+        input_format = detect_input_format(data)
+
+    if input_format == "json":
+        try:
+            with _profiler.stage("parse_json", len(data)):
+                base = json_to_proto(str(data, "utf-8"), message_desc, internal_desc)
+        except (UnicodeDecodeError, ValueError, json_format.ParseError) as e:
+            if not fallback:
+                raise InvalidInputError(
+                    f"Failed to parse input as JSON for the message type `{message_desc.name}`: {e}")
+        else:
+            if fields is None:
+                return base
+            elif not prune_before_parsing():
+                with _profiler.stage("prune_fields"):
+                    project_fields(base, fields)
+                return base
+            # JSON has to be parsed in full, and is then pruned like binary.
+            data = base.SerializeToString()
+
+    prune = fields is not None and prune_before_parsing()
+    if prune:
+        with _profiler.stage("prune_fields", len(data)):
+            data = prune_fields(data, fields)
+
+    base = message_class(message_desc)()
+    with _profiler.stage("parse_binary", len(data)):
         parse_proto_or_fail(base, data,
                             f"Failed to decode input as the message type `{message_desc.name}`. The data may be of another message type.")
-        return base
+    if fields is not None and not prune:
+        with _profiler.stage("prune_fields"):
+            project_fields(base, fields)
+    return base
+
 
+# Skipping fields in Python only beats parsing them with the pure-Python
+# backend. The native backends parse whole messages much faster, so the
+# unselected fields are cleared afterwards instead.
+def prune_before_parsing():
+    return protobuf_backend() == "python"
 
-def json_to_proto(json, message_desc, internal_desc):
-    base = message_desc._concrete_class()
-    (doctored_json, internals) = extract_internal_protos(json, base, internal_desc)
-    json_format.Parse(doctored_json, base)
-    if internals:
+
+# Clears the fields of a parsed message that aren't selected. Internal
+# messages are still bytes at this point, so they're pruned like binary.
+def project_fields(message, selection):
+    FieldDescriptor = protobuf_module("descriptor").FieldDescriptor
+
+    for (field, value) in message.ListFields():
+        if field.number not in selection:
+            if field.is_extension:
+                message.ClearExtension(field)
+            else:
+                message.ClearField(field.name)
+            continue
+
+        nested = selection[field.number]
+        if nested is None:
+            continue
+        elif field.message_type and is_repeated(field):
+            for item in value:
+                project_fields(item, nested)
+        elif field.message_type:
+            project_fields(value, nested)
+        elif field.type == FieldDescriptor.TYPE_BYTES and not is_repeated(field):
+            setattr(message, field.name, prune_fields(value, nested))
+
+
+# JSON messages are objects, so a message is only worth parsing as JSON if
+# it starts with `{`. Binary messages rarely do: it would be the tag of a
+# group, which are deprecated. If one does, parsing falls back to binary.
+def detect_input_format(data):
+    index = 0
+    while index < len(data) and data[index] in JSON_WHITESPACE:
+        index += 1
+    return "json" if data[index:index + 1] == b"{" else "binary"
+
+
+def stream_record_format(framing, input_format):
+    if input_format != "auto":
+        return input_format
+    return "binary" if framing == "delimited" else "json"
+
+
+def json_to_proto(json_string, message_desc, internal_desc):
+    json_format = protobuf_module("json_format")
+
+    base = message_class(message_desc)()
+    plan = get_internal_plan(message_desc, internal_desc)
+    if plan is None:
+        json_format.Parse(json_string, base)
+        return base
+
+    data = json.loads(json_string)
+    with _profiler.stage("extract_internal_protos"):
+        internals = extract_internal_protos(data, plan)
+    json_format.ParseDict(data, base)
+    with _profiler.stage("reinstate_internals"):
         reinstate_internals(internals, base)
     return base
 
 
-def proto_to_json(message, internal_desc, including_default_value_fields=False):
-    json_encoded = json_format.MessageToJson(
-        message,
-        including_default_value_fields=including_default_value_fields)
+def proto_to_json(message, internal_desc, including_default_value_fields=False, indent=2):
+    json_format = protobuf_module("json_format")
 
-    if internal_desc is None:
-        return json_encoded
+    plan = get_internal_plan(message.DESCRIPTOR, internal_desc)
+    if plan is None:
+        return json_format.MessageToJson(
+            message, indent=indent,
+            **json_printing_options(including_default_value_fields))
 
-    data = json.loads(json_encoded)
+    data = json_format.MessageToDict(
+        message, **json_printing_options(including_default_value_fields))
 
-    def unpack_internals(desc, message, obj):
-        for field in desc.fields:
-            json_field_name = get_json_name(field.name)
-            if field.type == FieldDescriptor.TYPE_BYTES:
-                internal_bytes = getattr(message, field.name)
-                obj.pop(json_field_name)
-                internal_message = internal_desc._concrete_class()
-                parse_proto_or_fail(internal_message, internal_bytes,
-                                    f"Failed to decode internal type as {internal_desc.name}.")
-                internal_message_json = json_format.MessageToJson(
-                    internal_message,
-                    including_default_value_fields=including_default_value_fields)
-                obj[json_field_name] = json.loads(internal_message_json)
-            elif field.message_type:
-                unpack_internals(field.message_type, getattr(
-                    message, field.name), obj[json_field_name])
-
-    unpack_internals(message.DESCRIPTOR, message, data)
+    def unpack_internals(plan, message, obj):
+        for (field_name, json_field_name, field_plan) in plan.message_fields:
+            if json_field_name in obj:
+                unpack_internals(field_plan, getattr(
+                    message, field_name), obj[json_field_name])
 
-    return json.dumps(data, indent=2)
+        for (field_name, json_field_name, field_desc, field_plan) in plan.bytes_fields:
+            if json_field_name not in obj:
+                continue
+            internal_message = message_class(field_desc)()
+            parse_proto_or_fail(internal_message, getattr(message, field_name),
+                                f"Failed to decode internal type as {field_desc.name}.")
+            # Replacing the key moves it to the end, as it always has.
+            obj.pop(json_field_name)
+            obj[json_field_name] = json_format.MessageToDict(
+                internal_message,
+                **json_printing_options(including_default_value_fields))
+            if field_plan is not None:
+                unpack_internals(field_plan, internal_message, obj[json_field_name])
+
+    unpack_internals(plan, message, data)
+
+    return json.dumps(data, indent=indent)
+
+
+# These are written by json_format itself, because they have special JSON forms.
+JSON_SPECIAL_TYPES = {
+    "google.protobuf." + name for name in [
+        "Any", "Duration", "FieldMask", "ListValue", "Struct", "Timestamp", "Value",
+        "BoolValue", "BytesValue", "DoubleValue", "FloatValue", "Int32Value",
+        "Int64Value", "StringValue", "UInt32Value", "UInt64Value",
+    ]
+}
+
+
+# Writes the same JSON as proto_to_json (without default value fields), but
+# field by field, so the whole document is never held in memory at once.
+def write_json(stream, message, internal_desc, indent=2):
+    writer = IncrementalJsonWriter(stream, indent)
+    writer.write_message(
+        message, get_internal_plan(message.DESCRIPTOR, internal_desc), 0)
+
+
+class IncrementalJsonWriter:
+    def __init__(self, stream, indent):
+        self.stream = stream
+        self.indent = indent
+        # These match the separators json.dumps uses with and without an indent.
+        self.item_separator = "," if indent is not None else ", "
+
+    def newline(self, level):
+        if self.indent is None:
+            return ""
+        return "\n" + " " * (self.indent * level)
+
+    def write_message(self, message, plan, level):
+        json_format = protobuf_module("json_format")
+
+        if message.DESCRIPTOR.full_name in JSON_SPECIAL_TYPES:
+            self.write_value(json_format.MessageToDict(message), level)
+            return
+
+        field_plans = {}
+        internal_fields = {}
+        if plan is not None:
+            field_plans = {field_name: field_plan
+                           for (field_name, _, field_plan) in plan.message_fields}
+            internal_fields = {field_name: None
+                               for (field_name, *_) in plan.bytes_fields}
+            internal_plans = {field_name: (field_desc, field_plan)
+                              for (field_name, _, field_desc, field_plan) in plan.bytes_fields}
+
+        self.stream.write("{")
+        count = 0
+        for (field, value) in message.ListFields():
+            if field.is_extension:
+                name = f"[{field.full_name}]"
+            elif field.name in internal_fields:
+                # Internal messages go last, as they do in proto_to_json.
+                internal_fields[field.name] = (field, value)
+                continue
+            else:
+                name = field.json_name
+            self.write_key(name, level, count)
+            self.write_field(field, value, field_plans.get(field.name), level + 1)
+            count += 1
 
+        for entry in internal_fields.values():
+            if entry is None:
+                continue
+            (field, value) = entry
+            (field_desc, field_plan) = internal_plans[field.name]
+            internal_message = message_class(field_desc)()
+            parse_proto_or_fail(internal_message, value,
+                                f"Failed to decode internal type as {field_desc.name}.")
+            self.write_key(field.json_name, level, count)
+            self.write_message(internal_message, field_plan, level + 1)
+            count += 1
+
+        if count:
+            self.stream.write(self.newline(level))
+        self.stream.write("}")
+
+    def write_key(self, name, level, count):
+        if count:
+            self.stream.write(self.item_separator)
+        self.stream.write(self.newline(level + 1))
+        self.stream.write(json.dumps(name))
+        self.stream.write(": ")
+
+    def write_field(self, field, value, plan, level):
+        if field.message_type and field.message_type.GetOptions().map_entry:
+            value_field = field.message_type.fields_by_name["value"]
+            self.stream.write("{")
+            for (count, key) in enumerate(value):
+                if isinstance(key, bool):
+                    key = "true" if key else "false"
+                self.write_key(str(key), level, count)
+                self.write_single_value(value_field, value[key], None, level + 1)
+            if len(value):
+                self.stream.write(self.newline(level))
+            self.stream.write("}")
+        elif is_repeated(field):
+            self.stream.write("[")
+            for (count, item) in enumerate(value):
+                if count:
+                    self.stream.write(self.item_separator)
+                self.stream.write(self.newline(level + 1))
+                self.write_single_value(field, item, None, level + 1)
+            if len(value):
+                self.stream.write(self.newline(level))
+            self.stream.write("]")
+        else:
+            self.write_single_value(field, value, plan, level)
 
-def extract_internal_protos(json_string, base_message, internal_desc):
+    def write_single_value(self, field, value, plan, level):
+        if field.message_type:
+            self.write_message(value, plan, level)
+        else:
+            self.stream.write(json.dumps(scalar_to_json(field, value)))
+
+    # Small values are written by json.dumps, re-indented to fit in place.
+    def write_value(self, value, level):
+        encoded = json.dumps(value, indent=self.indent)
+        if self.indent is not None:
+            encoded = encoded.replace("\n", self.newline(level))
+        self.stream.write(encoded)
+
+
+# Converts a scalar field value the same way as json_format.
+def scalar_to_json(field, value):
+    FieldDescriptor = protobuf_module("descriptor").FieldDescriptor
+
+    cpp_type = field.cpp_type
+    if cpp_type == FieldDescriptor.CPPTYPE_ENUM:
+        if field.enum_type.full_name == "google.protobuf.NullValue":
+            return None
+        enum_value = field.enum_type.values_by_number.get(value)
+        return enum_value.name if enum_value is not None else value
+    elif cpp_type == FieldDescriptor.CPPTYPE_STRING:
+        if field.type == FieldDescriptor.TYPE_BYTES:
+            return base64.b64encode(value).decode("utf-8")
+        return value
+    elif cpp_type == FieldDescriptor.CPPTYPE_BOOL:
+        return bool(value)
+    elif cpp_type in (FieldDescriptor.CPPTYPE_INT64, FieldDescriptor.CPPTYPE_UINT64):
+        return str(value)
+    elif cpp_type in (FieldDescriptor.CPPTYPE_FLOAT, FieldDescriptor.CPPTYPE_DOUBLE):
+        if math.isinf(value):
+            return "-Infinity" if value < 0 else "Infinity"
+        elif math.isnan(value):
+            return "NaN"
+        elif cpp_type == FieldDescriptor.CPPTYPE_FLOAT:
+            return protobuf_module("internal.type_checkers").ToShortestFloat(value)
+    return value
+
+
+class InternalPlan:
+    def __init__(self, bytes_fields):
+        # (field name, JSON name, internal type, plan for the internal type)
+        # of each singular bytes field that holds an internal message.
+        self.bytes_fields = bytes_fields
+        # (field name, JSON name, plan) of each singular message field that
+        # leads to a bytes field.
+        self.message_fields = ()
+
+
+# Plans only depend on the schema, so they are shared by every message.
+# A message type with no bytes fields within reach has no plan (None).
+_internal_plans = {}
+
+
+def get_internal_plan(message_desc, internal_desc):
     if internal_desc is None:
-        return (json_string, None)
+        return None
 
-    def extract_internals(desc, obj, internals, path):
-        for field in desc.fields:
-            field_path = path + [field.name]
-            json_field_name = get_json_name(field.name)
-            if field.type == FieldDescriptor.TYPE_BYTES:
-                internal_obj = obj.pop(json_field_name)
-                internal_json = json.dumps(internal_obj)
-                internal_base = internal_desc._concrete_class()
-                internal_message = json_format.Parse(
-                    internal_json, internal_base)
-                internals.append((field_path, internal_message))
-            elif field.message_type:
-                extract_internals(field.message_type,
-                                  obj[json_field_name], internals, field_path)
-
-    desc = base_message.DESCRIPTOR
-    data = json.loads(json_string)
-    internals = []
-    extract_internals(desc, data, internals, [])
+    key = (message_desc, internal_desc)
+    if key in _internal_plans:
+        return _internal_plans[key]
 
-    return (json.dumps(data), internals)
+    with cache_lock():
+        if key not in _internal_plans:
+            if isinstance(internal_desc, InternalTypes):
+                _internal_plans[key] = build_mapped_internal_plan(
+                    message_desc, internal_desc.fields)
+            else:
+                _internal_plans.update(
+                    build_internal_plans(message_desc, internal_desc))
+        return _internal_plans[key]
+
+
+def build_internal_plans(message_desc, internal_desc):
+    from google.protobuf.descriptor import FieldDescriptor
+
+    def singular_fields(desc):
+        return [field for field in desc.fields
+                if not is_repeated(field)]
+
+    # Find every message type reachable through singular message fields.
+    descs = [message_desc]
+    seen = {message_desc}
+    for desc in descs:
+        for field in singular_fields(desc):
+            if field.message_type and field.message_type not in seen:
+                seen.add(field.message_type)
+                descs.append(field.message_type)
+
+    plans = {}
+    for desc in descs:
+        bytes_fields = tuple((field.name, field.json_name, internal_desc, None)
+                             for field in singular_fields(desc)
+                             if field.type == FieldDescriptor.TYPE_BYTES)
+        if bytes_fields:
+            plans[desc] = InternalPlan(bytes_fields)
+
+    # Types that only contain bytes fields indirectly need a plan too. This
+    # repeats until nothing changes, because message types can be recursive.
+    changed = True
+    while changed:
+        changed = False
+        for desc in descs:
+            if desc not in plans and any(field.message_type in plans
+                                         for field in singular_fields(desc)):
+                plans[desc] = InternalPlan(())
+                changed = True
+
+    for (desc, plan) in plans.items():
+        plan.message_fields = tuple((field.name, field.json_name, plans[field.message_type])
+                                    for field in singular_fields(desc)
+                                    if field.message_type in plans)
+
+    return {(desc, internal_desc): plans.get(desc) for desc in descs}
+
+
+# Builds the plan for internal types that are given per field. The paths
+# can lead into internal messages, which then have plans of their own.
+def build_mapped_internal_plan(message_desc, fields):
+    from google.protobuf.descriptor import FieldDescriptor
+
+    fields_by_name = {}
+    for (path, internal_desc) in fields:
+        fields_by_name.setdefault(path[0], []).append((path[1:], internal_desc))
+
+    bytes_fields = []
+    message_fields = []
+    for (name, entries) in fields_by_name.items():
+        field = find_field(message_desc, name)
+        if field is None:
+            raise ProtopadError(
+                f"Unknown field '{name}' for the message type `{message_desc.name}`")
+        if is_repeated(field):
+            raise ProtopadError(
+                f"The field `{field.name}` is repeated, so it can't have internal types")
+
+        internal_descs = [internal_desc for (path, internal_desc) in entries if not path]
+        nested_fields = [(path, internal_desc) for (path, internal_desc) in entries if path]
+        if field.type == FieldDescriptor.TYPE_BYTES and internal_descs:
+            internal_desc = internal_descs[-1]
+            field_plan = build_mapped_internal_plan(
+                internal_desc, nested_fields) if nested_fields else None
+            bytes_fields.append(
+                (field.name, field.json_name, internal_desc, field_plan))
+        elif field.message_type and not internal_descs:
+            message_fields.append((field.name, field.json_name, build_mapped_internal_plan(
+                field.message_type, nested_fields)))
+        else:
+            raise ProtopadError(
+                f"The field `{field.name}` of `{message_desc.name}` isn't a bytes field")
+
+    plan = InternalPlan(tuple(bytes_fields))
+    plan.message_fields = tuple(message_fields)
+    return plan
+
+
+# Internal types for specific bytes fields, given as paths of field names
+# from the main message type (like `--internal-field a.b=Type`).
+class InternalTypes:
+    def __init__(self, fields):
+        self.fields = tuple(sorted(fields.items()))
+
+    def __eq__(self, other):
+        return isinstance(other, InternalTypes) and self.fields == other.fields
+
+    def __hash__(self):
+        return hash(self.fields)
+
+
+# Internal types come from `--internal-type` (for every bytes field),
+# `--internal-field` (per field), or the `internal_types` config for the type.
+def resolve_internal_types(get_message_desc, message_desc, internal_type, internal_fields):
+    if internal_type:
+        return get_message_desc(internal_type)
+
+    if not internal_fields:
+        try:
+            with open(DOTFILE_PATH, "r") as f:
+                config = json.load(f)
+        except FileNotFoundError:
+            config = {}
+        mapping = config.get("internal_types", {}).get(message_desc.full_name)
+        if not mapping:
+            return None
+        internal_fields = [f"{path}={type_name}"
+                           for (path, type_name) in mapping.items()]
+
+    fields = {}
+    for internal_field in internal_fields:
+        (path, _, type_name) = internal_field.partition("=")
+        if not path or not type_name:
+            raise ProtopadError(
+                f"Invalid internal field `{internal_field}`. Use `path.to.field=MessageType`.")
+        fields[tuple(path.split("."))] = get_message_desc(type_name)
+
+    internal_types = InternalTypes(fields)
+    # Building the plan checks that the paths are valid.
+    get_internal_plan(message_desc, internal_types)
+    return internal_types
+
+
+def find_field(message_desc, name):
+    field = message_desc.fields_by_name.get(name)
+    if field is None:
+        field = next((field for field in message_desc.fields
+                      if field.json_name == name), None)
+    return field
+
+
+def extract_internal_protos(data, plan):
+    json_format = protobuf_module("json_format")
+
+    # JSON input may use either the JSON name or the original field name.
+    def find_key(obj, field_name, json_field_name):
+        if json_field_name in obj:
+            return json_field_name
+        return field_name if field_name in obj else None
+
+    def extract_internals(plan, obj, internals, path):
+        if not isinstance(obj, dict):
+            return
+
+        for (field_name, json_field_name, field_plan) in plan.message_fields:
+            key = find_key(obj, field_name, json_field_name)
+            if key is not None:
+                extract_internals(field_plan, obj[key],
+                                  internals, path + [field_name])
+
+        for (field_name, json_field_name, field_desc, field_plan) in plan.bytes_fields:
+            key = find_key(obj, field_name, json_field_name)
+            if key is not None:
+                internal_obj = obj.pop(key)
+                if internal_obj is None:
+                    continue
+                if not isinstance(internal_obj, dict):
+                    raise InvalidInputError(
+                        f"The internal message `{'.'.join(path + [field_name])}` must be a JSON object, "
+                        f"not {json.dumps(internal_obj)}")
+                nested_internals = []
+                if field_plan is not None:
+                    extract_internals(field_plan, internal_obj, nested_internals, [])
+                internal_message = json_format.ParseDict(
+                    internal_obj, message_class(field_desc)())
+                reinstate_internals(nested_internals, internal_message)
+                internals.append((path + [field_name], internal_message))
+
+    internals = []
+    extract_internals(plan, data, internals, [])
+    return internals
 
 
 def reinstate_internals(internals, message):
@@ -369,60 +2718,301 @@ def reinstate_internals(internals, message):
         setattr(target, path[-1], binary)
 
 
+# Each edit gets a file of its own, so that edits at the same time don't
+# overwrite each other. It then becomes the most recent edit (`--recent`).
 def interactive_edit_message(message_json, editor_command=None):
+    import shlex
+    import subprocess
+    import tempfile
+
     editor = editor_command if editor_command else os.environ["EDITOR"]
 
-    with open(TEMPFILE_PATH, "w") as f:
-        f.write(message_json)
+    (fd, edit_path) = tempfile.mkstemp(
+        prefix="edit-", suffix=".json", dir=os.path.dirname(TEMPFILE_PATH))
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(message_json)
 
-    result = subprocess.run(f"{editor} {TEMPFILE_PATH}", shell=True)
+        result = subprocess.run(f"{editor} {shlex.quote(edit_path)}", shell=True)
 
-    with open(TEMPFILE_PATH, "r") as f:
-        edited_result = f.read()
+        with open(edit_path, "r") as f:
+            edited_result = f.read()
+        os.replace(edit_path, TEMPFILE_PATH)
+    except BaseException:
+        remove_file(edit_path)
+        raise
 
     return edited_result
 
 
-def create_template_message(message_descriptor, empty):
-    message_class = message_descriptor._concrete_class
-    base = message_class()
+def create_template_message(message_descriptor, empty, max_depth=TEMPLATE_MAX_DEPTH):
+    base = message_class(message_descriptor)()
     if not empty:
-        for field in message_descriptor.fields:
-            if field.message_type:
-                if field.label == FieldDescriptor.LABEL_REPEATED:
-                    placeholder_value = create_template_message(
-                        field.message_type, False)
-                    field_container = getattr(base, field.name, None)
-                    try:
-                        # Repeated type
-                        dest = field_container.add()
-                        dest.MergeFrom(placeholder_value)
-                    except AttributeError:
-                        # Map type - leave blank for now
-                        pass
-                else:
-                    getattr(base, field.name).MergeFrom(
-                        create_template_message(field.message_type, False))
+        with cache_lock():
+            template = build_template(message_descriptor, max_depth, frozenset())
+        base.CopyFrom(template)
+    return base
+
+
+# Templates are shared by every message, so they must not be modified.
+_templates = {}
+_reachable_types = {}
+
+
+# Every message field is filled with a template of its own, down to
+# `depth` levels. A type isn't expanded inside itself: recursive fields are
+# left as empty messages. So the types above a template only change it if
+# they can be reached from it, and are part of the key only then.
+def build_template(message_desc, depth, ancestors):
+    ancestors = ancestors & reachable_types(message_desc)
+    key = (message_desc, depth, ancestors)
+    template = _templates.get(key)
+    if template is not None:
+        return template
+
+    template = message_class(message_desc)()
+    if depth > 0:
+        inner_ancestors = ancestors | {message_desc}
+        for field in template_fields(message_desc):
+            field_template = build_template(
+                field.message_type,
+                0 if field.message_type in inner_ancestors else depth - 1,
+                inner_ancestors)
+            if is_repeated(field):
+                getattr(template, field.name).add().MergeFrom(field_template)
+            else:
+                placeholder = getattr(template, field.name)
+                placeholder.SetInParent()
+                placeholder.MergeFrom(field_template)
+
+    _templates[key] = template
+    return template
+
+
+# Map fields are left empty.
+def template_fields(message_desc):
+    return [field for field in message_desc.fields
+            if field.message_type and not field.message_type.GetOptions().map_entry]
+
+
+def reachable_types(message_desc):
+    if message_desc not in _reachable_types:
+        reachable = set()
+        pending = [message_desc]
+        while pending:
+            for field in template_fields(pending.pop()):
+                if field.message_type not in reachable:
+                    reachable.add(field.message_type)
+                    pending.append(field.message_type)
+        _reachable_types[message_desc] = frozenset(reachable)
+    return _reachable_types[message_desc]
+
+
+# Empty internal messages get templates of their own, so that their fields
+# show up in the editor too.
+def fill_internal_templates(message, plan, max_depth=TEMPLATE_MAX_DEPTH):
+    if plan is None:
+        return
+    for (field_name, _, field_desc, field_plan) in plan.bytes_fields:
+        if not getattr(message, field_name):
+            internal_message = create_template_message(field_desc, False, max_depth)
+            fill_internal_templates(internal_message, field_plan, max_depth)
+            setattr(message, field_name, internal_message.SerializeToString())
+    for (field_name, _, field_plan) in plan.message_fields:
+        if message.HasField(field_name):
+            fill_internal_templates(getattr(message, field_name), field_plan, max_depth)
+
+
+def template_cache_path():
+    return os.path.join(COMPILED_PATH, TEMPLATE_CACHE_FILENAME)
+
+
+# Templates of the compiled message types are also kept in a file next to
+# them, so that large schemas don't have to be expanded on every edit.
+def load_template_message(message_desc, max_depth=TEMPLATE_MAX_DEPTH):
+    try:
+        with open(template_cache_path(), "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    stamp = compiled_tree_stamp()
+    if cache.get("stamp") != stamp:
+        cache = {"stamp": stamp, "templates": {}}
+
+    key = f"{message_desc.full_name}:{max_depth}"
+    encoded = cache["templates"].get(key)
+    if encoded is not None:
+        base = message_class(message_desc)()
+        try:
+            base.ParseFromString(base64.b64decode(encoded))
+            return base
+        except Exception:
+            pass
+
+    base = create_template_message(message_desc, False, max_depth)
+    cache["templates"][key] = base64.b64encode(base.SerializeToString()).decode()
+    # The cache is only an optimization, so failing to write it is not fatal.
+    try:
+        write_json_atomically(template_cache_path(), cache)
+    except OSError:
+        pass
     return base
 
 
 def ensure_dotfiles_exist():
-    os.makedirs(os.path.expanduser("~/.protopad/compiled"), exist_ok=True)
+    os.makedirs(COMPILED_PATH, exist_ok=True)
     if not os.path.exists(DOTFILE_PATH):
         with open(DOTFILE_PATH, "w") as f:
             json.dump({}, f)
 
 
-def main():
+# Records the wall time, CPU time and bytes processed by each stage of a
+# command, when it's run with `--profile`.
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}
+        self.cprofile = None
+        self.cprofile_path = None
+        self.start_times = None
+
+    def start(self, cprofile_path=None):
+        import time
+
+        self.enabled = True
+        if cprofile_path:
+            import cProfile
+
+            self.cprofile = cProfile.Profile()
+            self.cprofile_path = cprofile_path
+            self.cprofile.enable()
+        self.start_times = (time.perf_counter(), time.process_time())
+
+    # Batch workers are forked from the profiled process, but only report
+    # their stages, which the parent merges.
+    def detach(self, enabled):
+        if self.cprofile:
+            self.cprofile.disable()
+            self.cprofile = None
+        self.enabled = enabled
+        self.stages = {}
+
+    def stage(self, name, nbytes=0):
+        if not self.enabled:
+            return _NULL_STAGE
+        return ProfileStage(self, name, nbytes)
+
+    def timed_records(self, name, records):
+        if not self.enabled:
+            return records
+        return self.time_records(name, records)
+
+    def time_records(self, name, records):
+        import time
+
+        records = iter(records)
+        while True:
+            (wall, cpu) = (time.perf_counter(), time.process_time())
+            record = next(records, None)
+            if record is None:
+                return
+            self.record(name, time.perf_counter() - wall,
+                        time.process_time() - cpu, len(record))
+            yield record
+
+    # The daemon records stages from several threads at once.
+    def record(self, name, wall_seconds, cpu_seconds, nbytes, count=1):
+        with shared_lock("profiler"):
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = {
+                    "count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "bytes": 0}
+            stats["count"] += count
+            stats["wall_seconds"] += wall_seconds
+            stats["cpu_seconds"] += cpu_seconds
+            stats["bytes"] += nbytes
+
+    def merge(self, stages):
+        for (name, stats) in stages.items():
+            self.record(name, stats["wall_seconds"], stats["cpu_seconds"],
+                        stats["bytes"], stats["count"])
+
+    def take(self):
+        if not self.enabled:
+            return None
+        with shared_lock("profiler"):
+            (stages, self.stages) = (self.stages, {})
+        return stages
+
+    def finish(self, command):
+        import time
+
+        if not self.enabled:
+            return
+        if self.cprofile:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofile_path)
+
+        (wall, cpu) = self.start_times
+        report = {
+            "command": command,
+            "wall_seconds": time.perf_counter() - wall,
+            "cpu_seconds": time.process_time() - cpu,
+            "stages": self.stages,
+        }
+        eprint(json.dumps(report))
+
+
+class ProfileStage:
+    def __init__(self, profiler, name, nbytes=0):
+        self.profiler = profiler
+        self.name = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        if self.profiler:
+            import time
+
+            self.start_times = (time.perf_counter(), time.process_time())
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profiler:
+            import time
+
+            (wall, cpu) = self.start_times
+            self.profiler.record(self.name, time.perf_counter() - wall,
+                                 time.process_time() - cpu, self.nbytes)
+
+
+# Stages of unprofiled commands share this one, which records nothing.
+_NULL_STAGE = ProfileStage(None, None)
+_profiler = Profiler()
+
+
+def check_protobuf_version():
+    import re
     from google.protobuf import __version__ as protobuf_version
-    major, minor, _ = [int(part) for part in protobuf_version.split(".")]
-    if major < 3 or minor < 6:
+
+    # Pre-releases like 4.21.0rc2 count as their release.
+    def version_tuple(version):
+        return tuple(int(re.match(r"\d*", part).group() or 0) for part in version.split(".")[:3])
+
+    if version_tuple(protobuf_version) < version_tuple(MIN_PROTOBUF_VERSION):
         eprint(
-            f"protopad: Incompatible version of protobuf installed: {protobuf_version}. Requires at least version 3.6.0.")
+            f"protopad: Incompatible version of protobuf installed: {protobuf_version}. Requires at least version {MIN_PROTOBUF_VERSION}.")
         eprint("protopad: Try running `pip install -r requirements.txt` in the protopad repo to install the correct version.")
         exit(1)
+    return protobuf_version
 
-    ensure_dotfiles_exist()
+
+def main():
+    # Answer `--version` without even loading argparse.
+    if sys.argv[1:] in (["--version"], ["-V"]):
+        print(VERSION)
+        return
+
+    import argparse
 
     parser = argparse.ArgumentParser(
         prog="protopad",
@@ -431,13 +3021,23 @@ def main():
     parser.add_argument(
         "--verbose", "-v", help="enable verbose logging", action="store_true")
     parser.add_argument(
-        "--version", "-V", action="version", version="0.9.0")
+        "--version", "-V", action="version", version=VERSION)
 
     subparsers = parser.add_subparsers(help="subcommands")
 
+    # Every subcommand can be profiled.
+    profile_parser = argparse.ArgumentParser(add_help=False)
+    profile_parser.add_argument(
+        "--profile", help="print the time spent and bytes processed in each stage as JSON on stderr",
+        action="store_true")
+    profile_parser.add_argument(
+        "--profile-output", metavar="FILE",
+        help="also run the command under cProfile and write its stats to this file (implies `--profile`)")
+
     # json command
     json_cmd_parser = subparsers.add_parser(
-        "json", help="read a JSON or protobuf message and output JSON")
+        "json", help="read a JSON or protobuf message and output JSON",
+        parents=[profile_parser])
     json_cmd_parser.set_defaults(task="json")
     json_cmd_parser.add_argument(
         "file", help="the file to read, or stdin if not specified", nargs="?")
@@ -445,12 +3045,48 @@ def main():
         "--output", "-o", help="a file to write to, or stdout if not specified")
     json_cmd_parser.add_argument(
         "--type", "-t", help="the protobuf message type", required=True)
-    json_cmd_parser.add_argument(
+    json_internal_group = json_cmd_parser.add_mutually_exclusive_group()
+    json_internal_group.add_argument(
         "--internal-type", "-i", help="the protobuf message type represented by any bytes-type fields, if any")
+    json_internal_group.add_argument(
+        "--internal-field", metavar="PATH=TYPE", action="append",
+        help="the protobuf message type represented by one bytes-type field, given by its path (like `a.b=Type`). Can be repeated, and replaces any `internal_types` from the config")
+    json_cmd_parser.add_argument(
+        "--input-format", choices=["auto", "json", "binary"], default="auto",
+        help="how to parse the input: JSON, binary protobuf, or detected from the first bytes (the default)")
+    json_cmd_parser.add_argument(
+        "--fields", "-f", metavar="PATHS",
+        help="only output these comma-separated field paths (like `a.b,c`), skipping the other fields without decoding them")
+    json_cmd_parser.add_argument(
+        "--incremental", help="write the JSON field by field as the message is converted, instead of building it all in memory first",
+        action="store_true")
+    json_record_group = json_cmd_parser.add_mutually_exclusive_group()
+    json_record_group.add_argument(
+        "--record", type=int, metavar="N",
+        help="only convert record N (counting from 0, or from the end if negative) of a file of length-delimited records. The records are found with an index file next to it (`FILE.idx`), which is created or updated as needed")
+    json_record_group.add_argument(
+        "--range", metavar="START:STOP",
+        help="only convert the records from START up to (but not including) STOP of a file of length-delimited records, found with its index file")
+    json_record_group.add_argument(
+        "--key", metavar="PATH=VALUE",
+        help="only convert the records of a file of length-delimited records where the field PATH is VALUE. The values are kept in the index file")
+    json_cmd_parser.add_argument(
+        "--no-daemon", help="convert in this process even if a `protopad serve` daemon is running",
+        action="store_true")
+    json_cmd_parser.add_argument(
+        "--batch", "-b", metavar="DIR",
+        help="convert every file in this directory (recursively) using a pool of worker processes, writing the results to the `--output` directory")
+    json_cmd_parser.add_argument(
+        "--jobs", "-j", type=int,
+        help="the number of worker processes for `--batch`, or the number of CPUs by default")
+    json_cmd_parser.add_argument(
+        "--stream", "-s", choices=["delimited", "lines"],
+        help="read a stream of length-delimited protobuf or newline-delimited JSON records, and write one JSON line per record")
 
     # proto command
     proto_cmd_parser = subparsers.add_parser(
-        "proto", help="read a JSON or protobuf message and output protobuf")
+        "proto", help="read a JSON or protobuf message and output protobuf",
+        parents=[profile_parser])
     proto_cmd_parser.set_defaults(task="proto")
     proto_cmd_parser.add_argument(
         "file", help="the file to read, or stdin if not specified", nargs="?")
@@ -458,13 +3094,114 @@ def main():
         "--output", "-o", help="a file to write to, or stdout if not specified")
     proto_cmd_parser.add_argument(
         "--type", "-t", help="the protobuf message type", required=True)
+    proto_internal_group = proto_cmd_parser.add_mutually_exclusive_group()
+    proto_internal_group.add_argument(
+        "--internal-type", "-i", help="the protobuf message type represented by any bytes-type fields, if any")
+    proto_internal_group.add_argument(
+        "--internal-field", metavar="PATH=TYPE", action="append",
+        help="the protobuf message type represented by one bytes-type field, given by its path (like `a.b=Type`). Can be repeated, and replaces any `internal_types` from the config")
+    proto_cmd_parser.add_argument(
+        "--input-format", choices=["auto", "json", "binary"], default="auto",
+        help="how to parse the input: JSON, binary protobuf, or detected from the first bytes (the default)")
+    proto_record_group = proto_cmd_parser.add_mutually_exclusive_group()
+    proto_record_group.add_argument(
+        "--record", type=int, metavar="N",
+        help="only convert record N (counting from 0, or from the end if negative) of a file of length-delimited records. The records are found with an index file next to it (`FILE.idx`), which is created or updated as needed")
+    proto_record_group.add_argument(
+        "--range", metavar="START:STOP",
+        help="only convert the records from START up to (but not including) STOP of a file of length-delimited records, found with its index file")
+    proto_record_group.add_argument(
+        "--key", metavar="PATH=VALUE",
+        help="only convert the records of a file of length-delimited records where the field PATH is VALUE. The values are kept in the index file")
+    proto_cmd_parser.add_argument(
+        "--no-daemon", help="convert in this process even if a `protopad serve` daemon is running",
+        action="store_true")
     proto_cmd_parser.add_argument(
+        "--batch", "-b", metavar="DIR",
+        help="convert every file in this directory (recursively) using a pool of worker processes, writing the results to the `--output` directory")
+    proto_cmd_parser.add_argument(
+        "--jobs", "-j", type=int,
+        help="the number of worker processes for `--batch`, or the number of CPUs by default")
+    proto_cmd_parser.add_argument(
+        "--stream", "-s", choices=["delimited", "lines"],
+        help="read a stream of length-delimited protobuf or newline-delimited JSON records, and write length-delimited protobuf")
+
+    # query command
+    query_cmd_parser = subparsers.add_parser(
+        "query", help="output the records of a stream that match some conditions",
+        parents=[profile_parser])
+    query_cmd_parser.set_defaults(task="query")
+    query_cmd_parser.add_argument(
+        "file", help="the file to read, or stdin if not specified", nargs="?")
+    query_cmd_parser.add_argument(
+        "--output", "-o", help="a file to write to, or stdout if not specified")
+    query_cmd_parser.add_argument(
+        "--type", "-t", help="the protobuf message type", required=True)
+    query_internal_group = query_cmd_parser.add_mutually_exclusive_group()
+    query_internal_group.add_argument(
+        "--internal-type", "-i", help="the protobuf message type represented by any bytes-type fields, if any")
+    query_internal_group.add_argument(
+        "--internal-field", metavar="PATH=TYPE", action="append",
+        help="the protobuf message type represented by one bytes-type field, given by its path (like `a.b=Type`). Can be repeated, and replaces any `internal_types` from the config")
+    query_cmd_parser.add_argument(
+        "--where", "-w", metavar="CONDITION", action="append", required=True,
+        help="only output records where this is true: `path`, `!path`, or `path OP value` with one of ==, !=, <, <=, >, >= or ~ (a regular expression). Can be repeated, and records must match all of them")
+    query_cmd_parser.add_argument(
+        "--stream", "-s", choices=["delimited", "lines"], default="delimited",
+        help="read length-delimited protobuf records (the default) or newline-delimited JSON records")
+    query_cmd_parser.add_argument(
+        "--input-format", choices=["auto", "json", "binary"], default="auto",
+        help="how to parse the records: JSON, binary protobuf, or detected from the first bytes (the default)")
+    query_cmd_parser.add_argument(
+        "--output-format", choices=["json", "binary"], default="json",
+        help="write matching records as JSON lines (the default) or as length-delimited protobuf")
+    query_cmd_parser.add_argument(
+        "--fields", "-f", metavar="PATHS",
+        help="only output these comma-separated field paths (like `a.b,c`) of the matching records")
+    query_cmd_parser.add_argument(
+        "--limit", "-n", type=int, help="stop after this many matching records")
+
+    # export command
+    export_cmd_parser = subparsers.add_parser(
+        "export", help="export a stream of records as columns, to CSV, Parquet or NumPy arrays",
+        parents=[profile_parser])
+    export_cmd_parser.set_defaults(task="export")
+    export_cmd_parser.add_argument(
+        "file", help="the file to read, or stdin if not specified", nargs="?")
+    export_cmd_parser.add_argument(
+        "--output", "-o", help="a file to write to, or stdout if not specified (only for CSV)")
+    export_cmd_parser.add_argument(
+        "--type", "-t", help="the protobuf message type", required=True)
+    export_internal_group = export_cmd_parser.add_mutually_exclusive_group()
+    export_internal_group.add_argument(
         "--internal-type", "-i", help="the protobuf message type represented by any bytes-type fields, if any")
+    export_internal_group.add_argument(
+        "--internal-field", metavar="PATH=TYPE", action="append",
+        help="the protobuf message type represented by one bytes-type field, given by its path (like `a.b=Type`). Can be repeated, and replaces any `internal_types` from the config")
+    export_cmd_parser.add_argument(
+        "--format", "-F", choices=EXPORT_FORMATS, default="csv",
+        help="write CSV (the default), Parquet (needs pyarrow) or a NumPy structured array in a .npy file (needs numpy)")
+    export_cmd_parser.add_argument(
+        "--stream", "-s", choices=["delimited", "lines"], default="delimited",
+        help="read length-delimited protobuf records (the default) or newline-delimited JSON records")
+    export_cmd_parser.add_argument(
+        "--input-format", choices=["auto", "json", "binary"], default="auto",
+        help="how to parse the records: JSON, binary protobuf, or detected from the first bytes (the default)")
+    export_cmd_parser.add_argument(
+        "--fields", "-f", metavar="PATHS",
+        help="only export the columns of these comma-separated field paths (like `a.b,c`)")
+    export_cmd_parser.add_argument(
+        "--explode", metavar="PATH",
+        help="give each element of this repeated field a row of its own, instead of exporting its fields as list columns. Records where it's empty are left out")
+    export_cmd_parser.add_argument(
+        "--batch-size", type=int, default=EXPORT_BATCH_SIZE, metavar="N",
+        help=f"how many records to decode before writing them (default {EXPORT_BATCH_SIZE})")
 
     # edit command
     # TODO: Fix pipes?
     edit_cmd_parser = subparsers.add_parser(
-        "edit", help="create or edit a protobuf message in an editor")
+        "edit", help="create or edit a protobuf message in an editor",
+        parents=[profile_parser])
     edit_cmd_parser.set_defaults(task="edit")
     edit_group = edit_cmd_parser.add_mutually_exclusive_group()
     edit_group.add_argument(
@@ -480,14 +3217,33 @@ def main():
         "--output", "-o", help="a file to write to, or stdout if not specified", required=True)
     edit_cmd_parser.add_argument(
         "--type", "-t", help="the protobuf message type", required=True)
-    edit_cmd_parser.add_argument(
+    edit_internal_group = edit_cmd_parser.add_mutually_exclusive_group()
+    edit_internal_group.add_argument(
         "--internal-type", "-i", help="the protobuf message type represented by any bytes-type fields, if any")
+    edit_internal_group.add_argument(
+        "--internal-field", metavar="PATH=TYPE", action="append",
+        help="the protobuf message type represented by one bytes-type field, given by its path (like `a.b=Type`). Can be repeated, and replaces any `internal_types` from the config")
+    edit_cmd_parser.add_argument(
+        "--input-format", choices=["auto", "json", "binary"], default="auto",
+        help="how to parse the input: JSON, binary protobuf, or detected from the first bytes (the default)")
     edit_cmd_parser.add_argument(
         "--editor", help="the editor command to use, or $EDITOR by default")
+    edit_cmd_parser.add_argument(
+        "--template-depth", type=int, default=TEMPLATE_MAX_DEPTH, metavar="N",
+        help=f"how many levels of nested messages to fill in the default message (default {TEMPLATE_MAX_DEPTH})")
+
+    # serve command
+    serve_cmd_parser = subparsers.add_parser(
+        "serve", help="run a daemon that keeps message types loaded and converts messages for other protopad commands",
+        parents=[profile_parser])
+    serve_cmd_parser.set_defaults(task="serve")
+    serve_cmd_parser.add_argument(
+        "--socket", help="the Unix socket to listen on", default=SOCKET_PATH)
 
     # register command
     register_cmd_parser = subparsers.add_parser(
-        "register", help="register a folder of protobuf definitions")
+        "register", help="register a folder of protobuf definitions",
+        parents=[profile_parser])
     register_cmd_parser.set_defaults(task="register")
     register_group = register_cmd_parser.add_mutually_exclusive_group(
         required=True)
@@ -500,12 +3256,33 @@ def main():
         "--recompile", "-c",
         help="recompiles registered proto definitions (this happens automatically when registering)",
         action="store_true")
+    register_group.add_argument(
+        "--compile-mode", choices=COMPILE_MODES,
+        help="how to compile registered proto definitions: into a Python module per file (the default), or into a single descriptor set that message types are loaded from on demand")
     register_cmd_parser.add_argument(
         "--remove", "-r", help="un-register this path",
         action="store_true")
+    register_cmd_parser.add_argument(
+        "--full", help="discard all compiled definitions and recompile from scratch, instead of only recompiling changed files",
+        action="store_true")
 
     args = vars(parser.parse_args())
     if "task" not in args:
         parser.print_help()
         exit(2)
-    protopad(args)
+
+    ensure_dotfiles_exist()
+    if args["profile"] or args["profile_output"]:
+        _profiler.start(args["profile_output"])
+    try:
+        protopad(args)
+    except ProtopadError as e:
+        fail(1, str(e))
+    except BrokenPipeError:
+        # The reader (like `head`) stopped early. Python flushes stdout again
+        # when it exits, so it's pointed at devnull to stop that failing too.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        exit(1)
+    finally:
+        _profiler.finish(args["task"])
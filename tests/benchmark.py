@@ -0,0 +1,234 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from google.protobuf import __version__ as protobuf_version
+
+import protopad
+
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def generate_schema(package, depth, width):
+    lines = ['syntax = "proto3";', "", f"package {package};", ""]
+    lines += ["message Leaf {", "    string text = 1;", "    int32 number = 2;", "}", ""]
+
+    for level in range(depth):
+        lines.append(f"message Level{level} {{")
+        lines += ["    string name = 1;",
+                  "    int64 id = 2;",
+                  "    double score = 3;",
+                  "    bytes blob = 4;",
+                  "    repeated string tags = 5;"]
+        field_number = 6
+        if level + 1 < depth:
+            lines.append(f"    Level{level + 1} child = {field_number};")
+            lines.append(
+                f"    repeated Level{level + 1} children = {field_number + 1};")
+            field_number += 2
+        for i in range(width):
+            lines.append(f"    int32 value_{i} = {field_number + i};")
+        lines += ["}", ""]
+
+    return "\n".join(lines)
+
+
+def fill_message(message, leaf_class, repeat, seed):
+    desc = message.DESCRIPTOR
+    message.name = f"message {seed}"
+    message.id = seed * 1000003
+    message.score = seed / 7
+    message.blob = leaf_class(text=f"leaf {seed}", number=seed).SerializeToString()
+    message.tags.extend(f"tag {i}" for i in range(repeat))
+    for field in desc.fields:
+        if field.name.startswith("value_"):
+            setattr(message, field.name, seed + field.number)
+    if "child" in desc.fields_by_name:
+        fill_message(message.child, leaf_class, repeat, seed + 1)
+        for i in range(repeat):
+            fill_message(message.children.add(), leaf_class, repeat, seed + i)
+    return message
+
+
+# Each call of `function` performs `operations` operations on `total_bytes` bytes.
+def measure(name, function, iterations, operations=1, total_bytes=0):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    seconds = time.perf_counter() - start
+
+    # Memory is measured in a second pass, because tracing slows everything down.
+    tracemalloc.start()
+    for _ in range(iterations):
+        function()
+    (_, peak_memory) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        "name": name,
+        "iterations": iterations,
+        "operations": iterations * operations,
+        "seconds": seconds,
+        "operations_per_second": iterations * operations / seconds if seconds else None,
+        "peak_memory_bytes": peak_memory,
+    }
+    if total_bytes:
+        result["bytes_per_second"] = iterations * total_bytes / seconds if seconds else None
+    print(f"  {name}: {seconds:.4f}s", file=sys.stderr)
+    return result
+
+
+def use_protopad_home(home):
+    protopad.DOTFILE_PATH = os.path.join(home, "config.json")
+    protopad.TEMPFILE_PATH = os.path.join(home, "temp.json")
+    protopad.COMPILED_PATH = os.path.join(home, "compiled")
+    protopad.ensure_dotfiles_exist()
+
+
+def measure_startup(home, runs):
+    env = dict(os.environ, HOME=home)
+
+    def run(command):
+        start = time.perf_counter()
+        output = subprocess.run(command, env=env, cwd=REPO_PATH, check=True,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        return (time.perf_counter() - start, output.stderr.decode())
+
+    # The last line of the `-X importtime` report is the protopad module itself.
+    (_, report) = run([sys.executable, "-X", "importtime", "-c", "import protopad"])
+    cumulative_us = int(report.strip().splitlines()[-1].split("|")[1])
+    results = [{"name": "startup_import_protopad", "seconds": cumulative_us / 1e6}]
+
+    commands = [
+        ("startup_python", [sys.executable, "-c", "pass"]),
+        ("startup_version", [sys.executable, "protopad", "--version"]),
+        ("startup_register_list", [sys.executable, "protopad", "register", "--list"]),
+    ]
+    for (name, command) in commands:
+        times = [run(command)[0] for _ in range(runs)]
+        results.append({
+            "name": name,
+            "iterations": runs,
+            "seconds": sum(times),
+            "best_seconds": min(times),
+        })
+        print(f"  {name}: {min(times):.4f}s", file=sys.stderr)
+
+    return results
+
+
+def run_benchmarks(options, workdir):
+    results = measure_startup(os.path.join(workdir, "startup"), options.startups)
+    app = protopad.Protopad()
+    use_protopad_home(os.path.join(workdir, "home"))
+
+    proto_dir = os.path.join(workdir, "protos")
+    for i in range(options.files):
+        package = f"bench{i}"
+        os.makedirs(os.path.join(proto_dir, package))
+        with open(os.path.join(proto_dir, package, "schema.proto"), "w") as f:
+            f.write(generate_schema(package, options.depth, options.width))
+
+    with open(protopad.DOTFILE_PATH, "w") as f:
+        json.dump({"paths": [proto_dir]}, f)
+
+    results.append(measure("recompile_protos", lambda: app.recompile_protos(full=True), 1))
+    results.append(measure("recompile_protos_unchanged", app.recompile_protos, 1))
+
+    type_name = f"bench{options.files - 1}.Level0"
+    results.append(measure("get_message_desc",
+                           lambda: app.get_message_desc(type_name), options.lookups))
+
+    message_desc = app.get_message_desc(type_name)
+    leaf_desc = app.get_message_desc(f"bench{options.files - 1}.Leaf")
+    (message_class, leaf_class) = (protopad.message_class(message_desc),
+                                   protopad.message_class(leaf_desc))
+    messages = [fill_message(message_class(), leaf_class, options.repeat, seed)
+                for seed in range(options.messages)]
+    binaries = [message.SerializeToString() for message in messages]
+    jsons = [protopad.proto_to_json(message, None).encode() for message in messages]
+    internal_jsons = [protopad.proto_to_json(message, leaf_desc).encode()
+                      for message in messages]
+    binary_bytes = sum(len(binary) for binary in binaries)
+    count = len(messages)
+
+    def each(function, inputs):
+        return lambda: [function(data) for data in inputs]
+
+    results += [
+        measure("parse_any_input_binary",
+                each(lambda data: protopad.parse_any_input(data, message_desc, None), binaries),
+                options.iterations, count, binary_bytes),
+        measure("parse_any_input_json",
+                each(lambda data: protopad.parse_any_input(data, message_desc, None), jsons),
+                options.iterations, count, sum(map(len, jsons))),
+        measure("parse_any_input_json_internal_type",
+                each(lambda data: protopad.parse_any_input(data, message_desc, leaf_desc),
+                     internal_jsons),
+                options.iterations, count, sum(map(len, internal_jsons))),
+        measure("proto_to_json",
+                each(lambda message: protopad.proto_to_json(message, None), messages),
+                options.iterations, count, binary_bytes),
+        measure("proto_to_json_internal_type",
+                each(lambda message: protopad.proto_to_json(message, leaf_desc), messages),
+                options.iterations, count, binary_bytes),
+        measure("create_template_message",
+                lambda: protopad.create_template_message(message_desc, False),
+                options.iterations * 10),
+    ]
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="benchmark protopad, printing the results as JSON")
+    parser.add_argument("--depth", type=int, default=4,
+                        help="the nesting depth of the generated message types")
+    parser.add_argument("--width", type=int, default=8,
+                        help="the number of extra scalar fields per message type")
+    parser.add_argument("--repeat", type=int, default=2,
+                        help="the number of elements in each repeated field")
+    parser.add_argument("--files", type=int, default=20,
+                        help="the number of generated .proto files")
+    parser.add_argument("--messages", type=int, default=50,
+                        help="the number of generated messages")
+    parser.add_argument("--iterations", type=int, default=5,
+                        help="how many times to convert the generated messages")
+    parser.add_argument("--lookups", type=int, default=20,
+                        help="how many times to look up a message type")
+    parser.add_argument("--startups", type=int, default=5,
+                        help="how many times to start the protopad command")
+    parser.add_argument("--output", "-o",
+                        help="a file to write the results to, or stdout if not specified")
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run_benchmarks(options, workdir)
+
+    report = {
+        "protopad_version": protopad.VERSION,
+        "protobuf_version": protobuf_version,
+        "protobuf_backend": protopad.protobuf_backend(),
+        "python_version": platform.python_version(),
+        "parameters": {key: value for (key, value) in vars(options).items() if key != "output"},
+        "results": results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
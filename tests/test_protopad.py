@@ -1,3 +1,14 @@
+import asyncio
+import concurrent.futures
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
 from testdata_pb2 import DESCRIPTOR
 
 import protopad
@@ -5,6 +16,36 @@ import protopad
 TEST_MESSAGE = DESCRIPTOR.message_types_by_name["TestMessage"]
 OUTER = DESCRIPTOR.message_types_by_name["Outer"]
 INNER = DESCRIPTOR.message_types_by_name["Inner"]
+NODE = DESCRIPTOR.message_types_by_name["Node"]
+RECORD = DESCRIPTOR.message_types_by_name["Record"]
+
+
+@pytest.fixture
+def protopad_home(tmp_path, monkeypatch):
+    home = tmp_path / "home"
+    monkeypatch.setattr(protopad, "DOTFILE_PATH", str(home / "config.json"))
+    monkeypatch.setattr(protopad, "TEMPFILE_PATH", str(home / "temp.json"))
+    monkeypatch.setattr(protopad, "COMPILED_PATH", str(home / "compiled"))
+    monkeypatch.setattr(sys, "path", list(sys.path))
+    protopad.ensure_dotfiles_exist()
+    yield home
+
+    # Compiled modules are imported by name, so don't leak them between tests.
+    for (name, module) in list(sys.modules.items()):
+        # Namespace packages (like `google`) may only partly be in the home.
+        filename = getattr(module, "__file__", None)
+        paths = [filename] if filename else list(getattr(module, "__path__", []))
+        if paths and all(str(home) in path for path in paths):
+            del sys.modules[name]
+
+
+def write_protos(root, files):
+    for (name, source) in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(source)
+    return root
+
 
 class TestParseAnyInput:
 
@@ -24,3 +65,1080 @@ class TestParseAnyInput:
         result = protopad.parse_any_input(json, OUTER, TEST_MESSAGE)
         inner_result = protopad.parse_any_input(result.inner, TEST_MESSAGE, None)
         assert inner_result.text == "Five"
+
+
+class TestTypeIndex:
+
+    @pytest.fixture
+    def app(self, protopad_home, tmp_path):
+        protos = write_protos(tmp_path / "protos", {
+            "index_a/types.proto": 'syntax = "proto3"; package index_a; message Shared {} message OnlyA {}',
+            "index_b/types.proto": 'syntax = "proto3"; package index_b; message Shared {}',
+        })
+        app = protopad.Protopad()
+        app.register_proto_path(str(protos), False)
+        return app
+
+    def test_recompile_writes_index(self, app):
+        with open(protopad.type_index_path()) as f:
+            index = json.load(f)
+        assert ["OnlyA", "index_a.types_pb2", "index_a.OnlyA",
+                "index_a/types.proto"] in index["types"]
+        assert index["stamp"] == protopad.compiled_tree_stamp()
+
+    def test_lookup_uses_index_without_rescanning(self, app, monkeypatch):
+        def rescan():
+            assert False, "The index should have been reused"
+        monkeypatch.setattr(app, "build_type_index", rescan)
+
+        assert app.get_message_desc("OnlyA").full_name == "index_a.OnlyA"
+        assert app.get_message_desc("index_b.Shared").full_name == "index_b.Shared"
+
+    def test_ambiguous_lookup_fails(self, app):
+        with pytest.raises(protopad.ProtopadError, match="ambiguous"):
+            app.get_message_desc("Shared")
+
+    def test_index_is_rebuilt_when_compiled_tree_changes(self, app):
+        module_path = os.path.join(protopad.COMPILED_PATH, "index_b", "types_pb2.py")
+        os.remove(module_path)
+
+        with pytest.raises(protopad.ProtopadError):
+            app.get_message_desc("index_b.Shared")
+        assert app.get_message_desc("Shared").full_name == "index_a.Shared"
+
+
+class TestIncrementalRecompile:
+
+    @pytest.fixture
+    def protos(self, protopad_home, tmp_path):
+        return write_protos(tmp_path / "protos", {
+            "incremental/base.proto": 'syntax = "proto3"; package incremental; message Base {}',
+            "incremental/user.proto": 'syntax = "proto3"; package incremental; import "incremental/base.proto"; message User { Base base = 1; }',
+            "incremental/other.proto": 'syntax = "proto3"; package incremental; message Other {}',
+        })
+
+    @pytest.fixture
+    def compiled_batches(self, monkeypatch):
+        batches = []
+        compile_proto_batch = protopad.compile_proto_batch
+
+        def recording_compile(path, relpaths, output_dir):
+            batches.append(relpaths)
+            return compile_proto_batch(path, relpaths, output_dir)
+
+        monkeypatch.setattr(protopad, "compile_proto_batch", recording_compile)
+        return batches
+
+    def compiled_files(self, batches):
+        return sorted(relpath for batch in batches for relpath in batch)
+
+    def test_only_changed_files_and_dependents_are_recompiled(self, protos, compiled_batches):
+        app = protopad.Protopad()
+        app.register_proto_path(str(protos), False)
+        assert len(self.compiled_files(compiled_batches)) == 3
+
+        compiled_batches.clear()
+        app.recompile_protos()
+        assert compiled_batches == []
+
+        (protos / "incremental/base.proto").write_text(
+            'syntax = "proto3"; package incremental; message Base { int32 id = 1; }')
+        app.recompile_protos()
+        assert self.compiled_files(compiled_batches) == [
+            "incremental/base.proto", "incremental/user.proto"]
+
+    def test_deleted_files_are_removed(self, protos):
+        app = protopad.Protopad()
+        app.register_proto_path(str(protos), False)
+        module_path = os.path.join(
+            protopad.COMPILED_PATH, "incremental", "other_pb2.py")
+        assert os.path.exists(module_path)
+
+        (protos / "incremental/other.proto").unlink()
+        app.recompile_protos()
+        assert not os.path.exists(module_path)
+
+    def test_failed_files_are_reported_and_retried(self, protos, compiled_batches):
+        (protos / "incremental/other.proto").write_text("not a proto file")
+        app = protopad.Protopad()
+        with pytest.raises(protopad.CompileError):
+            app.register_proto_path(str(protos), False)
+
+        compiled_batches.clear()
+        with pytest.raises(protopad.CompileError, match="other.proto"):
+            app.recompile_protos()
+        assert self.compiled_files(compiled_batches) == ["incremental/other.proto"]
+
+
+class TestCompiledPackages:
+
+    @pytest.fixture
+    def protos(self, protopad_home, tmp_path):
+        protos = write_protos(tmp_path / "protos", {
+            "google/foo/bar.proto": 'syntax = "proto3"; package google.foo; message Bar { int32 id = 1; }',
+            "app/a.proto": 'syntax = "proto3"; package app; import "google/foo/bar.proto"; message A { google.foo.Bar bar = 1; }',
+            "broken/b.proto": 'syntax = "proto3"; package broken; message B { int32 id = 1; }',
+        })
+        protopad.Protopad().register_proto_path(str(protos), False)
+        return protos
+
+    def test_compiled_packages_merge_with_installed_ones(self, protos, monkeypatch):
+        assert not os.path.exists(os.path.join(protopad.COMPILED_PATH, "google", "__init__.py"))
+        # A fresh process hasn't imported the protobuf package yet, which is
+        # when a compiled `google` package could hide it.
+        script = (
+            "import json, sys, protopad\n"
+            "protopad.DOTFILE_PATH, protopad.COMPILED_PATH = sys.argv[1:3]\n"
+            "converter = protopad.Converter('app.A')\n"
+            "print(converter.to_json(b'{\"bar\": {\"id\": 3}}', indent=None))\n"
+            "assert sys.path[-1] == protopad.COMPILED_PATH\n")
+        output = subprocess.run(
+            [sys.executable, "-c", script, protopad.DOTFILE_PATH, protopad.COMPILED_PATH],
+            env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__))),
+            stdout=subprocess.PIPE, check=True).stdout
+        assert json.loads(output) == {"bar": {"id": 3}}
+        assert protopad.Protopad().get_message_desc("Bar").full_name == "google.foo.Bar"
+
+    def test_broken_modules_are_skipped(self, protos):
+        with open(os.path.join(protopad.COMPILED_PATH, "broken", "b_pb2.py"), "w") as f:
+            f.write("import missing_module\n")
+        sys.modules.pop("broken.b_pb2", None)
+        app = protopad.Protopad()
+        assert {entry[2] for entry in app.build_type_index()["types"]} == {"app.A", "google.foo.Bar"}
+
+
+class TestDescriptorSetMode:
+
+    @pytest.fixture
+    def protos(self, protopad_home, tmp_path):
+        protos = write_protos(tmp_path / "protos", {
+            "described/base.proto": 'syntax = "proto3"; package described; message Base { int32 id = 1; }',
+            "described/user.proto": 'syntax = "proto3"; package described; import "described/base.proto"; message User { Base base = 1; }',
+        })
+        with open(protopad.DOTFILE_PATH, "w") as f:
+            json.dump({"paths": [str(protos)], "compile_mode": "descriptor_set"}, f)
+        return protos
+
+    def compiled_modules(self):
+        return [filename for (_, _, filenames) in os.walk(protopad.COMPILED_PATH)
+                for filename in filenames if filename.endswith(".py")]
+
+    def test_loads_types_from_descriptor_set(self, protos):
+        app = protopad.Protopad()
+        app.recompile_protos()
+        assert self.compiled_modules() == []
+
+        user_desc = app.get_message_desc("User")
+        assert user_desc.fields_by_name["base"].message_type.full_name == "described.Base"
+        message = protopad.parse_any_input(b'{"base": {"id": 5}}', user_desc, None)
+        assert json.loads(protopad.proto_to_json(message, None)) == {"base": {"id": 5}}
+
+    def test_changing_mode_recompiles_everything(self, protos):
+        app = protopad.Protopad()
+        app.recompile_protos()
+        app.set_compile_mode("python")
+
+        assert not os.path.exists(protopad.descriptor_set_path())
+        assert sorted(self.compiled_modules()) == [
+            "__init__.py", "base_pb2.py", "user_pb2.py"]
+        assert app.get_message_desc("User").full_name == "described.User"
+
+    def test_failed_files_are_skipped(self, protos):
+        (protos / "described/broken.proto").write_text("not a proto file")
+        app = protopad.Protopad()
+        with pytest.raises(protopad.CompileError):
+            app.recompile_protos()
+
+        assert app.get_message_desc("User").full_name == "described.User"
+        with pytest.raises(protopad.UnknownTypeError):
+            app.get_message_desc("Broken")
+
+
+class TestStreaming:
+
+    def write_delimited(self, path, messages):
+        with open(path, "wb") as f:
+            for message in messages:
+                protopad.write_delimited_record(f, message.SerializeToString())
+
+    def test_delimited_to_json_lines(self, tmp_path):
+        messages = [protopad.message_class(TEST_MESSAGE)(text=f"message {i}") for i in range(3)]
+        self.write_delimited(tmp_path / "in.bin", messages)
+
+        protopad.Protopad().stream_to_json(
+            TEST_MESSAGE, None, str(tmp_path / "in.bin"), str(tmp_path / "out.jsonl"), "delimited")
+
+        lines = (tmp_path / "out.jsonl").read_text().splitlines()
+        assert [json.loads(line) for line in lines] == [
+            {"text": "message 0"}, {"text": "message 1"}, {"text": "message 2"}]
+
+    def test_json_lines_to_delimited_with_internal_type(self, tmp_path):
+        (tmp_path / "in.jsonl").write_text(
+            '{"inner": {"number": 1}}\n\n{"inner": {"number": 300}}\n')
+
+        protopad.Protopad().stream_to_proto(
+            OUTER, INNER, str(tmp_path / "in.jsonl"), str(tmp_path / "out.bin"), "lines")
+
+        with open(tmp_path / "out.bin", "rb") as f:
+            records = list(protopad.read_delimited_records(f))
+        numbers = [protopad.parse_any_input(protopad.message_class(OUTER).FromString(record).inner, INNER, None).number
+                   for record in records]
+        assert numbers == [1, 300]
+
+    def test_truncated_record_fails(self, tmp_path):
+        (tmp_path / "in.bin").write_bytes(protopad.encode_varint(10) + b"short")
+        with pytest.raises(protopad.ProtopadError):
+            protopad.Protopad().stream_to_json(
+                TEST_MESSAGE, None, str(tmp_path / "in.bin"), str(tmp_path / "out.jsonl"), "delimited")
+
+
+class TestIncrementalJson:
+
+    @pytest.fixture
+    def record(self):
+        record = protopad.message_class(RECORD)(
+            id=-(2 ** 40), count=7, score=float("inf"), ratio=0.1, active=True,
+            kind=2, data=protopad.message_class(INNER)(number=9).SerializeToString(),
+            tags=["a", "b\u00e9"], text_value="caf\u00e9",
+            inner=protopad.message_class(INNER)(number=3).SerializeToString())
+        record.nodes.add(name="first", child={"name": "grandchild"})
+        record.nodes.add()
+        record.totals["x"] = 1
+        record.totals["y"] = 2
+        record.nodes_by_id[5].name = "five"
+        record.created.seconds = 1700000000
+        record.created.nanos = 500
+        return record
+
+    def write(self, message, internal_desc, indent):
+        import io
+        stream = io.StringIO()
+        protopad.write_json(stream, message, internal_desc, indent=indent)
+        return stream.getvalue()
+
+    @pytest.mark.parametrize("indent", [2, None])
+    @pytest.mark.parametrize("internal_desc", [None, INNER])
+    def test_matches_proto_to_json(self, record, internal_desc, indent):
+        assert self.write(record, internal_desc, indent) == protopad.proto_to_json(
+            record, internal_desc, indent=indent)
+
+    def test_matches_proto_to_json_for_empty_messages(self):
+        message = protopad.message_class(RECORD)()
+        assert self.write(message, INNER, 2) == protopad.proto_to_json(message, INNER)
+        assert self.write(message, None, 2) == protopad.proto_to_json(message, None)
+
+    def test_nested_internals(self):
+        node = protopad.message_class(NODE)(name="root")
+        node.child.payload = protopad.message_class(INNER)(number=4).SerializeToString()
+        node.payload = protopad.message_class(INNER)(number=5).SerializeToString()
+        assert self.write(node, INNER, 2) == protopad.proto_to_json(node, INNER)
+
+
+class TestFieldSelection:
+
+    # Records are pruned before parsing for the pure-Python backend, and
+    # cleared after parsing for the native ones.
+    @pytest.fixture(autouse=True, params=["python", "upb"])
+    def backend(self, request, monkeypatch):
+        monkeypatch.setattr(protopad, "protobuf_backend", lambda: request.param)
+        return request.param
+
+    @pytest.fixture
+    def record(self):
+        record = protopad.message_class(RECORD)(
+            id=42, tags=["a", "b"], text_value="text",
+            inner=protopad.message_class(INNER)(number=3).SerializeToString())
+        record.nodes.add(name="first", payload=b"x")
+        record.nodes.add(child={"name": "grandchild"})
+        record.totals["x"] = 1
+        return record
+
+    def convert(self, data, paths, internal_desc=None):
+        fields = protopad.select_fields(paths, RECORD, internal_desc)
+        message = protopad.parse_any_input(data, RECORD, internal_desc, "auto", fields)
+        return json.loads(protopad.proto_to_json(message, internal_desc))
+
+    def test_selects_nested_fields(self, record):
+        assert self.convert(record.SerializeToString(), "id,nodes.name,totals") == {
+            "id": "42", "nodes": [{"name": "first"}, {}], "totals": {"x": 1}}
+
+    def test_selects_fields_of_internal_messages(self, record):
+        assert self.convert(record.SerializeToString(), "inner.number", INNER) == {
+            "inner": {"number": 3}}
+
+    def test_accepts_json_names(self, record):
+        assert self.convert(record.SerializeToString(), "textValue") == {"textValue": "text"}
+
+    def test_prunes_json_input(self, record):
+        data = protopad.proto_to_json(record, None).encode()
+        assert self.convert(data, "tags") == {"tags": ["a", "b"]}
+
+    def test_unselected_fields_are_not_decoded(self, record):
+        record.inner = b"\xff\xff\xff"
+        with pytest.raises(protopad.ProtopadError):
+            self.convert(record.SerializeToString(), "id,inner", INNER)
+        assert self.convert(record.SerializeToString(), "id", INNER) == {"id": "42"}
+
+    def test_only_prunes_before_parsing_for_the_python_backend(self, record, backend, monkeypatch):
+        pruned = []
+        prune_fields = protopad.prune_fields
+        monkeypatch.setattr(protopad, "prune_fields",
+                            lambda data, fields: pruned.append(data) or prune_fields(data, fields))
+        assert self.convert(record.SerializeToString(), "id") == {"id": "42"}
+        assert self.convert(protopad.proto_to_json(record, None).encode(), "id") == {"id": "42"}
+        assert len(pruned) == (2 if backend == "python" else 0)
+
+    def test_truncated_input_fails(self, record):
+        with pytest.raises(protopad.InvalidInputError):
+            self.convert(record.SerializeToString()[:-1], "id")
+        with pytest.raises(protopad.InvalidInputError, match="wire type"):
+            protopad.prune_fields(b"\x0f", {1: None})
+
+    def test_unknown_fields_fail(self):
+        with pytest.raises(protopad.ProtopadError, match="Unknown field 'missing'"):
+            protopad.select_fields("nodes.missing", RECORD, None)
+        with pytest.raises(protopad.ProtopadError):
+            protopad.select_fields("id.value", RECORD, None)
+
+
+class TestProfiler:
+
+    @pytest.fixture
+    def profiler(self, monkeypatch):
+        profiler = protopad.Profiler()
+        monkeypatch.setattr(protopad, "_profiler", profiler)
+        profiler.start()
+        return profiler
+
+    def test_records_stages_across_streamed_messages(self, profiler, tmp_path, capsys):
+        with open(tmp_path / "in.bin", "wb") as f:
+            for i in range(3):
+                protopad.write_delimited_record(f, protopad.message_class(
+                    TEST_MESSAGE)(text=f"message {i}").SerializeToString())
+
+        protopad.Protopad().stream_to_json(
+            TEST_MESSAGE, None, str(tmp_path / "in.bin"), str(tmp_path / "out.jsonl"), "delimited")
+        profiler.finish("json")
+
+        report = json.loads(capsys.readouterr().err)
+        assert report["command"] == "json"
+        stages = report["stages"]
+        assert stages["read_input"]["count"] == 3
+        assert stages["read_input"]["bytes"] == 3 * len(b"\n\tmessage 0")
+        assert stages["parse_binary"]["count"] == 3
+        assert stages["write_output"]["bytes"] == (tmp_path / "out.jsonl").stat().st_size
+
+    def test_merges_worker_stages(self, profiler):
+        with profiler.stage("parse_json", 10):
+            pass
+        worker_stages = profiler.take()
+        assert profiler.stages == {}
+
+        profiler.merge(worker_stages)
+        profiler.merge(worker_stages)
+        assert profiler.stages["parse_json"]["count"] == 2
+        assert profiler.stages["parse_json"]["bytes"] == 20
+
+    def test_records_nothing_when_disabled(self, monkeypatch):
+        profiler = protopad.Profiler()
+        monkeypatch.setattr(protopad, "_profiler", profiler)
+        protopad.parse_any_input(b'{ "text": "x" }', TEST_MESSAGE, None)
+        assert profiler.stages == {}
+
+
+class TestQuery:
+
+    # Conditions are checked on pruned records for the pure-Python backend.
+    @pytest.fixture(autouse=True, params=["python", "upb"])
+    def backend(self, request, monkeypatch):
+        monkeypatch.setattr(protopad, "protobuf_backend", lambda: request.param)
+
+    @pytest.fixture
+    def records(self, tmp_path):
+        record_class = protopad.message_class(RECORD)
+        inner_class = protopad.message_class(INNER)
+        records = [
+            record_class(id=i, kind=i % 3, tags=[f"tag {i}"],
+                         text_value="even" if i % 2 == 0 else "odd",
+                         inner=inner_class(number=i * 10).SerializeToString())
+            for i in range(10)]
+        records[3].nodes.add(name="three")
+        with open(tmp_path / "in.bin", "wb") as f:
+            for record in records:
+                protopad.write_delimited_record(f, record.SerializeToString())
+        return records
+
+    def query(self, tmp_path, conditions, internal_desc=None, **kwargs):
+        protopad.Protopad().query_records(
+            RECORD, internal_desc, str(tmp_path / "in.bin"), str(tmp_path / "out.jsonl"),
+            "delimited", conditions, **kwargs)
+        lines = (tmp_path / "out.jsonl").read_text().splitlines()
+        return [json.loads(line) for line in lines]
+
+    def ids(self, results):
+        return [int(result.get("id", 0)) for result in results]
+
+    def test_comparisons(self, records, tmp_path):
+        assert self.ids(self.query(tmp_path, ["id >= 7"])) == [7, 8, 9]
+        assert self.ids(self.query(tmp_path, ["id>2", "id<5", "text_value == odd"])) == [3]
+        assert self.ids(self.query(tmp_path, ["kind = LARGE", "id != 2"])) == [5, 8]
+        assert self.ids(self.query(tmp_path, ["tags ~ '[12]$'"])) == [1, 2]
+
+    def test_comparisons_include_default_values(self, records, tmp_path):
+        assert self.ids(self.query(tmp_path, ["id == 0"])) == [0]
+        assert self.ids(self.query(tmp_path, ["kind != LARGE", "id < 5"])) == [0, 1, 3, 4]
+        assert self.ids(self.query(tmp_path, ["active == false", "id <= 1"])) == [0, 1]
+        assert self.ids(self.query(tmp_path, ["count < 3", "id < 2"])) == [0, 1]
+
+    def test_presence(self, records, tmp_path):
+        assert self.ids(self.query(tmp_path, ["nodes.name"])) == [3]
+        assert self.ids(self.query(tmp_path, ["!id"])) == [0]
+
+    def test_conditions_on_internal_fields(self, records, tmp_path):
+        results = self.query(tmp_path, ["inner.number >= 80"], INNER, fields=protopad.select_fields(
+            "id,inner", RECORD, INNER))
+        assert results == [{"id": "8", "inner": {"number": 80}}, {"id": "9", "inner": {"number": 90}}]
+
+    def test_limit_and_binary_output(self, records, tmp_path):
+        protopad.Protopad().query_records(
+            RECORD, None, str(tmp_path / "in.bin"), str(tmp_path / "out.bin"),
+            "delimited", ["text_value == even"], output_format="binary", limit=2)
+        with open(tmp_path / "out.bin", "rb") as f:
+            matches = [protopad.message_class(RECORD).FromString(record)
+                       for record in protopad.read_delimited_records(f)]
+        assert matches == [records[0], records[2]]
+
+    def test_invalid_conditions_fail(self, records, tmp_path):
+        for condition in ["id ~ 1", "id == x", "nodes == 1", "missing", "id <> 1"]:
+            with pytest.raises(protopad.ProtopadError):
+                self.query(tmp_path, [condition])
+
+
+class TestRecordIndex:
+
+    @pytest.fixture
+    def records(self, tmp_path):
+        record_class = protopad.message_class(RECORD)
+        records = [record_class(id=i, text_value=f"record {i % 4}") for i in range(20)]
+        self.write(tmp_path / "in.bin", records)
+        return records
+
+    def write(self, path, records):
+        with open(path, "wb") as f:
+            for record in records:
+                protopad.write_delimited_record(f, record.SerializeToString())
+
+    def convert(self, tmp_path, task="json", **kwargs):
+        output = tmp_path / ("out.json" if task == "json" else "out.bin")
+        protopad.Protopad().convert_indexed_records(
+            task, RECORD, None, str(tmp_path / "in.bin"), str(output), **kwargs)
+        if task == "proto":
+            return output.read_bytes()
+        elif "record" in kwargs:
+            return json.loads(output.read_text())
+        return [json.loads(line) for line in output.read_text().splitlines()]
+
+    def ids(self, results):
+        return [int(result.get("id", 0)) for result in results]
+
+    def test_single_record(self, records, tmp_path):
+        assert self.convert(tmp_path, record=7) == {"id": "7", "textValue": "record 3"}
+        assert self.convert(tmp_path, "proto", record=-1) == records[-1].SerializeToString()
+
+    def test_range(self, records, tmp_path):
+        assert self.ids(self.convert(tmp_path, record_range="3:6")) == [3, 4, 5]
+        assert self.ids(self.convert(tmp_path, record_range="-2:")) == [18, 19]
+        assert self.convert(tmp_path, record_range="6:3") == []
+        self.convert(tmp_path, "proto", record_range=":2")
+        with open(tmp_path / "out.bin", "rb") as f:
+            assert [protopad.message_class(RECORD).FromString(record)
+                    for record in protopad.read_delimited_records(f)] == records[:2]
+
+    def test_key(self, records, tmp_path):
+        assert self.ids(self.convert(tmp_path, key="text_value=record 1")) == [1, 5, 9, 13, 17]
+        index = protopad.read_record_index(str(tmp_path / "in.bin.idx"))
+        assert index.header["key"] == "text_value"
+        assert self.ids(self.convert(tmp_path, key="id=12")) == [12]
+        assert self.ids(self.convert(tmp_path, key="id=0")) == [0]
+        assert len(self.convert(tmp_path, key="active=false")) == 20
+
+    def test_index_is_reused_until_the_file_changes(self, records, tmp_path):
+        self.convert(tmp_path, record=0)
+        index_path = tmp_path / "in.bin.idx"
+        mtime = index_path.stat().st_mtime_ns
+        self.convert(tmp_path, record=1)
+        assert index_path.stat().st_mtime_ns == mtime
+
+        self.write(tmp_path / "in.bin", records[:5])
+        assert self.ids(self.convert(tmp_path, record_range=":")) == [0, 1, 2, 3, 4]
+        assert protopad.read_record_index(str(index_path)).header["count"] == 5
+
+    def test_errors(self, records, tmp_path):
+        with pytest.raises(protopad.ProtopadError):
+            self.convert(tmp_path, record=20)
+        with pytest.raises(protopad.ProtopadError):
+            self.convert(tmp_path, record_range="a:b")
+        with open(tmp_path / "in.bin", "ab") as f:
+            f.write(b"\x10abc")
+        with pytest.raises(protopad.ProtopadError):
+            self.convert(tmp_path, record=0)
+
+
+class TestTemplates:
+
+    def test_recursive_types_are_expanded_once(self):
+        template = protopad.create_template_message(NODE, False)
+        assert template.HasField("child") and len(template.children) == 1
+        assert template.child.ListFields() == []
+
+        record = protopad.create_template_message(RECORD, False)
+        assert record.nodes[0] == template
+        assert record.HasField("created") and len(record.totals) == 0
+
+    def test_depth_limit(self):
+        record = protopad.create_template_message(RECORD, False, max_depth=1)
+        assert len(record.nodes) == 1 and record.nodes[0].ListFields() == []
+        assert protopad.create_template_message(RECORD, False, max_depth=0).ListFields() == []
+        assert protopad.create_template_message(RECORD, True).ListFields() == []
+
+    def test_templates_are_memoized(self):
+        assert (protopad.build_template(NODE, 3, frozenset())
+                is protopad.build_template(NODE, 3, frozenset([RECORD])))
+        template = protopad.create_template_message(NODE, False)
+        template.name = "changed"
+        assert protopad.create_template_message(NODE, False).name == ""
+
+    def test_empty_internal_fields_get_templates(self):
+        message = protopad.create_template_message(OUTER, False)
+        protopad.fill_internal_templates(message, protopad.get_internal_plan(OUTER, NODE))
+        node = protopad.message_class(NODE).FromString(message.inner)
+        assert node == protopad.create_template_message(NODE, False)
+
+    def test_templates_are_cached_on_disk(self, protopad_home, monkeypatch):
+        template = protopad.load_template_message(RECORD)
+        assert os.path.exists(protopad.template_cache_path())
+
+        def fail(*args):
+            raise AssertionError("the template should come from the cache")
+        monkeypatch.setattr(protopad, "create_template_message", fail)
+        assert protopad.load_template_message(RECORD) == template
+
+
+class TestExport:
+
+    @pytest.fixture
+    def records(self, tmp_path):
+        record_class = protopad.message_class(RECORD)
+        inner_class = protopad.message_class(INNER)
+        records = []
+        for i in range(5):
+            record = record_class(id=i, ratio=0.1 * i, active=i % 2 == 0, kind=i % 3,
+                                  tags=[f"tag {j}" for j in range(i % 3)], totals={"a": i},
+                                  inner=inner_class(number=i).SerializeToString())
+            record.nodes.add(name=f"node {i}").child.name = "child"
+            record.nodes.add(name="second", payload=b"\x01")
+            records.append(record)
+        with open(tmp_path / "in.bin", "wb") as f:
+            for record in records:
+                protopad.write_delimited_record(f, record.SerializeToString())
+        return records
+
+    def export(self, tmp_path, output_format="csv", internal_desc=None, **kwargs):
+        output = tmp_path / f"out.{output_format}"
+        protopad.Protopad().export_records(
+            RECORD, internal_desc, str(tmp_path / "in.bin"), str(output), "delimited",
+            output_format, **kwargs)
+        return output
+
+    def read_csv(self, path):
+        import csv
+
+        with open(path, newline="") as f:
+            return list(csv.DictReader(f))
+
+    def test_flattens_fields_into_columns(self):
+        plan = protopad.ExportPlan(RECORD, protopad.InternalTypes({("inner",): INNER}))
+        columns = {column.name: (column.kind, column.listed) for column in plan.columns}
+        assert columns["id"] == ("int64", False)
+        assert columns["tags"] == ("string", True)
+        assert columns["nodes.name"] == ("string", True)
+        # Recursive fields, maps and well-known types are kept as JSON.
+        assert columns["nodes.child"] == ("json", True)
+        assert columns["totals"] == ("json", False)
+        assert columns["created"] == ("json", False)
+        assert columns["inner.number"] == ("int32", False)
+        assert "inner" not in columns
+        assert plan.columns[0].typecode == "q"
+
+    def test_csv(self, records, tmp_path):
+        rows = self.read_csv(self.export(
+            tmp_path, internal_desc=protopad.InternalTypes({("inner",): INNER}), batch_size=2))
+        assert len(rows) == 5
+        assert rows[2]["id"] == "2" and rows[2]["inner.number"] == "2"
+        assert (rows[1]["ratio"], rows[1]["active"], rows[1]["kind"]) == ("0.1", "false", "SMALL")
+        assert json.loads(rows[2]["tags"]) == ["tag 0", "tag 1"]
+        assert json.loads(rows[0]["nodes.name"]) == ["node 0", "second"]
+        assert json.loads(rows[0]["nodes.payload"]) == ["", "AQ=="]
+        assert json.loads(rows[0]["nodes.child"]) == [{"name": "child"}, {}]
+        assert json.loads(rows[4]["totals"]) == {"a": 4}
+
+    def test_explode(self, records, tmp_path):
+        rows = self.read_csv(self.export(tmp_path, fields="id,nodes.name", explode="nodes"))
+        assert list(rows[0]) == ["id", "nodes.name"]
+        assert [(row["id"], row["nodes.name"]) for row in rows[:3]] == [
+            ("0", "node 0"), ("0", "second"), ("1", "node 1")]
+        assert len(rows) == 10
+
+        rows = self.read_csv(self.export(tmp_path, fields="id,tags", explode="tags"))
+        assert [(row["id"], row["tags"]) for row in rows] == [
+            ("1", "tag 0"), ("2", "tag 0"), ("2", "tag 1"), ("4", "tag 0")]
+
+    def test_explode_leaves_out_records_where_the_field_is_empty(self):
+        plan = protopad.ExportPlan(RECORD, None, "id,tags", "tags")
+        record_class = protopad.message_class(RECORD)
+        assert plan.extract(record_class(id=1)) == []
+        assert plan.extract(record_class(id=1, tags=["a", "b"])) == [[1, "a"], [1, "b"]]
+
+    def test_parquet(self, records, tmp_path):
+        parquet = pytest.importorskip("pyarrow.parquet")
+        table = parquet.read_table(self.export(tmp_path, "parquet", batch_size=2))
+        assert table.column("id").to_pylist() == [0, 1, 2, 3, 4]
+        assert table.column("active").to_pylist() == [True, False, True, False, True]
+        assert table.column("nodes.payload").to_pylist()[0] == [b"", b"\x01"]
+        assert str(table.schema.field("ratio").type) == "float"
+
+    def test_npy(self, records, tmp_path):
+        numpy = pytest.importorskip("numpy")
+        array = numpy.load(self.export(tmp_path, "npy", fields="id,active,kind,tags"))
+        assert array.dtype.names == ("id", "active", "kind", "tags")
+        assert array["id"].tolist() == [0, 1, 2, 3, 4]
+        assert array["active"].dtype == numpy.bool_
+        assert json.loads(array["tags"][2]) == ["tag 0", "tag 1"]
+
+        array = numpy.load(self.export(tmp_path, "npy", fields="nodes.payload", explode="nodes"))
+        assert array["nodes.payload"].tolist()[:2] == ["", "AQ=="]
+        array = numpy.load(self.export(tmp_path, "npy", fields="nodes.payload"))
+        assert array.dtype["nodes.payload"].kind == "U"
+        assert json.loads(array["nodes.payload"][0]) == ["", "AQ=="]
+
+    def test_invalid_options_fail(self, records, tmp_path):
+        for explode in ["id", "totals", "nodes.children"]:
+            with pytest.raises(protopad.ProtopadError):
+                self.export(tmp_path, explode=explode)
+        with pytest.raises(protopad.ProtopadError):
+            protopad.Protopad().export_records(
+                RECORD, None, str(tmp_path / "in.bin"), None, "delimited", "npy")
+
+
+class TestBatchConversion:
+
+    @pytest.fixture
+    def app(self, protopad_home, tmp_path):
+        protos = write_protos(tmp_path / "protos", {
+            "batch/records.proto": 'syntax = "proto3"; package batch; message Record { string id = 1; }',
+        })
+        app = protopad.Protopad()
+        app.register_proto_path(str(protos), False)
+        return app
+
+    def test_converts_files_and_reports_failures_per_file(self, app, tmp_path, capsys):
+        record_class = protopad.message_class(app.get_message_desc("Record"))
+        indir = tmp_path / "in"
+        (indir / "nested").mkdir(parents=True)
+        (indir / "a.bin").write_bytes(record_class(id="a").SerializeToString())
+        (indir / "nested" / "b.bin").write_bytes(record_class(id="b").SerializeToString())
+        (indir / "broken.bin").write_bytes(b"\xff\xff\xff")
+        outdir = tmp_path / "out"
+
+        with pytest.raises(protopad.ProtopadError, match="1 of 3"):
+            app.convert_batch("json", "Record", None, str(indir), str(outdir), jobs=2)
+
+        assert json.loads((outdir / "a.json").read_text()) == {"id": "a"}
+        assert json.loads((outdir / "nested" / "b.json").read_text()) == {"id": "b"}
+        assert not (outdir / "broken.json").exists()
+        errors = capsys.readouterr().err
+        assert "Failed: broken.bin" in errors
+        assert "Converted 2 files (1 failed)" in errors
+
+    def test_keeps_files_with_the_same_name_in_different_directories(self, app, tmp_path):
+        record_class = protopad.message_class(app.get_message_desc("Record"))
+        indir = tmp_path / "in"
+        for name in ("x", "y"):
+            (indir / name).mkdir(parents=True)
+            (indir / name / "a.bin").write_bytes(record_class(id=name).SerializeToString())
+        outdir = tmp_path / "out"
+
+        app.convert_batch("json", "Record", None, str(indir), str(outdir), jobs=2)
+        assert json.loads((outdir / "x" / "a.json").read_text()) == {"id": "x"}
+        assert json.loads((outdir / "y" / "a.json").read_text()) == {"id": "y"}
+
+    def test_refuses_inputs_with_the_same_output_file(self, app, tmp_path):
+        record_class = protopad.message_class(app.get_message_desc("Record"))
+        indir = tmp_path / "in"
+        indir.mkdir()
+        (indir / "a.bin").write_bytes(record_class(id="a").SerializeToString())
+        (indir / "a.pb").write_bytes(record_class(id="b").SerializeToString())
+        outdir = tmp_path / "out"
+
+        with pytest.raises(protopad.ProtopadError, match="a.bin, a.pb"):
+            app.convert_batch("json", "Record", None, str(indir), str(outdir), jobs=2)
+        assert not outdir.exists()
+
+
+class TestConverter:
+
+    @pytest.fixture
+    def payloads(self):
+        record_class = protopad.message_class(RECORD)
+        inner_class = protopad.message_class(INNER)
+        return [record_class(id=i, tags=[f"tag {i}"] * (i % 5),
+                             inner=inner_class(number=i).SerializeToString()).SerializeToString()
+                for i in range(200)]
+
+    def test_converts_by_type_name(self, protopad_home, tmp_path):
+        protos = write_protos(tmp_path / "protos", {
+            "library/user.proto": 'syntax = "proto3"; package library; message User { string name = 1; bytes extra = 2; }',
+        })
+        protopad.Protopad().register_proto_path(str(protos), False)
+
+        converter = protopad.Converter("library.User", internal_type="User")
+        extra = converter.to_binary(b'{"name": "b"}')
+        binary = converter.to_binary(
+            json.dumps({"name": "a", "extra": {"name": "b"}}).encode())
+        assert converter.parse(binary).extra == extra
+        assert json.loads(converter.to_json(binary)) == {"name": "a", "extra": {"name": "b"}}
+        with pytest.raises(protopad.UnknownTypeError):
+            protopad.Converter("Missing")
+
+    def test_batches_match_single_conversions(self, payloads):
+        converter = protopad.Converter(RECORD, INNER, fields="id,inner")
+        results = converter.to_json_batch(payloads)
+        assert results == [converter.to_json(data, indent=None) for data in payloads]
+        assert json.loads(results[3]) == {"id": "3", "inner": {"number": 3}}
+        assert converter.to_binary_batch(
+            [data.encode() for data in results]) == [converter.to_binary(data) for data in payloads]
+
+    def test_invalid_input_raises(self):
+        converter = protopad.Converter(RECORD, input_format="json")
+        with pytest.raises(protopad.InvalidInputError):
+            converter.to_binary(b"{not json")
+        with pytest.raises(protopad.InvalidInputError):
+            protopad.Converter(RECORD).to_json(b"\xff\xff\xff")
+
+    def test_can_be_shared_between_threads(self, payloads):
+        expected = protopad.Converter(RECORD, INNER).to_json_batch(payloads)
+        # Start from empty caches, so that the threads fill them at the same time.
+        protopad._internal_plans.clear()
+        protopad._templates.clear()
+        converter = protopad.Converter(RECORD, INNER)
+
+        def convert(offset):
+            rotated = payloads[offset:] + payloads[:offset]
+            template = protopad.create_template_message(RECORD, False)
+            return (converter.to_json_batch(rotated), template)
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(convert, range(0, 200, 25)))
+        for (offset, (converted, template)) in zip(range(0, 200, 25), results):
+            assert converted == expected[offset:] + expected[:offset]
+            assert template == protopad.create_template_message(RECORD, False)
+
+    def test_edits_use_separate_files(self, protopad_home):
+        results = []
+        threads = [threading.Thread(target=lambda i=i: results.append(
+            protopad.interactive_edit_message(
+                json.dumps({"number": i}), editor_command="sleep 0.1; sed -i s/number/n/")))
+            for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert sorted(json.loads(result)["n"] for result in results) == [0, 1, 2, 3]
+        assert json.loads(open(protopad.TEMPFILE_PATH).read())["n"] in range(4)
+        assert not [name for name in os.listdir(protopad_home) if name.startswith("edit-")]
+
+
+class TestInternalPlans:
+
+    def test_plan_lists_bytes_fields(self):
+        plan = protopad.get_internal_plan(OUTER, INNER)
+        assert plan.bytes_fields == (("inner", "inner", INNER, None),)
+        assert plan.message_fields == ()
+        assert protopad.get_internal_plan(TEST_MESSAGE, INNER) is None
+        assert protopad.get_internal_plan(OUTER, None) is None
+
+    def test_plan_is_memoized(self):
+        assert protopad.get_internal_plan(NODE, INNER) is protopad.get_internal_plan(NODE, INNER)
+
+    def test_recursive_types_share_a_plan(self):
+        plan = protopad.get_internal_plan(NODE, INNER)
+        assert plan.bytes_fields == (("payload", "payload", INNER, None),)
+        assert plan.message_fields == (("child", "child", plan),)
+
+    def test_nested_internals_round_trip(self):
+        inner = protopad.message_class(INNER)(number=7).SerializeToString()
+        node = protopad.message_class(NODE)(name="root", payload=inner)
+        node.child.child.payload = inner
+
+        result = protopad.proto_to_json(node, INNER)
+        assert json.loads(result) == {
+            "name": "root",
+            "child": {"child": {"payload": {"number": 7}}},
+            "payload": {"number": 7},
+        }
+        assert protopad.json_to_proto(result, NODE, INNER) == node
+
+    def test_malformed_internal_json_is_invalid_input(self):
+        for payload in [b'{"inner": 5}', b'{"inner": [1]}', b'{"inner": "x"}']:
+            with pytest.raises(protopad.InvalidInputError):
+                protopad.parse_any_input(payload, OUTER, INNER)
+        assert protopad.parse_any_input(b'{"inner": null}', OUTER, INNER).inner == b""
+
+    def test_empty_plan_skips_reencoding(self):
+        message = protopad.message_class(TEST_MESSAGE)(text="plain")
+        assert protopad.proto_to_json(message, INNER) == protopad.proto_to_json(message, None)
+
+
+class TestInternalFieldMap:
+
+    TYPES = {"Inner": INNER, "Node": NODE, "Outer": OUTER}
+
+    def resolve(self, message_desc, internal_fields):
+        return protopad.resolve_internal_types(
+            self.TYPES.__getitem__, message_desc, None, internal_fields)
+
+    def test_only_mapped_fields_are_decoded(self):
+        record = protopad.message_class(RECORD)(
+            data=b"\xff not a message",
+            inner=protopad.message_class(INNER)(number=3).SerializeToString())
+        internal_types = self.resolve(RECORD, ["inner=Inner"])
+
+        result = protopad.proto_to_json(record, internal_types)
+        assert json.loads(result) == {"data": "/yBub3QgYSBtZXNzYWdl", "inner": {"number": 3}}
+        assert protopad.json_to_proto(result, RECORD, internal_types) == record
+
+    def test_internal_types_can_contain_internal_types(self):
+        inner = protopad.message_class(INNER)(number=5).SerializeToString()
+        outer = protopad.message_class(OUTER)(inner=inner).SerializeToString()
+        node = protopad.message_class(NODE)(name="root")
+        node.child.payload = outer
+        internal_types = self.resolve(NODE, ["child.payload=Outer", "child.payload.inner=Inner"])
+
+        result = protopad.proto_to_json(node, internal_types)
+        assert json.loads(result) == {
+            "name": "root", "child": {"payload": {"inner": {"number": 5}}}}
+        assert protopad.json_to_proto(result, NODE, internal_types) == node
+
+        import io
+        stream = io.StringIO()
+        protopad.write_json(stream, node, internal_types)
+        assert stream.getvalue() == result
+
+        fields = protopad.select_fields("child.payload.inner.number", NODE, internal_types)
+        selected = protopad.parse_any_input(node.SerializeToString(), NODE, internal_types, "auto", fields)
+        assert selected.child == node.child and not selected.name
+
+    def test_mapping_is_read_from_the_config(self, protopad_home):
+        with open(protopad.DOTFILE_PATH, "w") as f:
+            json.dump({"internal_types": {"Outer": {"inner": "Inner"}}}, f)
+        internal_types = self.resolve(OUTER, None)
+        assert protopad.get_internal_plan(OUTER, internal_types).bytes_fields == (
+            ("inner", "inner", INNER, None),)
+        assert self.resolve(NODE, None) is None
+
+    def test_invalid_paths_fail(self):
+        with pytest.raises(protopad.ProtopadError, match="isn't a bytes field"):
+            self.resolve(NODE, ["name=Inner"])
+        with pytest.raises(protopad.ProtopadError, match="repeated"):
+            self.resolve(NODE, ["children.payload=Inner"])
+        with pytest.raises(protopad.ProtopadError, match="Invalid internal field"):
+            self.resolve(NODE, ["payload"])
+
+
+class TestInputFormat:
+
+    def test_detects_json_objects(self):
+        assert protopad.detect_input_format(b' \n\t{ "text": "x" }') == "json"
+
+    def test_detects_binary(self):
+        binary = protopad.message_class(TEST_MESSAGE)(text="x").SerializeToString()
+        assert binary.startswith(b"\n")
+        assert protopad.detect_input_format(binary) == "binary"
+        assert protopad.detect_input_format(b"") == "binary"
+
+    def test_binary_that_looks_like_json_falls_back(self):
+        binary = protopad.message_class(TEST_MESSAGE)(text="{" * 123).SerializeToString()
+        assert protopad.detect_input_format(binary) == "json"
+        assert protopad.parse_any_input(binary, TEST_MESSAGE, None).text == "{" * 123
+
+    def test_explicit_json_reports_parse_errors(self):
+        with pytest.raises(protopad.ProtopadError, match="JSON"):
+            protopad.parse_any_input(b'{ "unknown": 1 }', TEST_MESSAGE, None, "json")
+
+    def test_explicit_binary_skips_json(self):
+        with pytest.raises(protopad.ProtopadError):
+            protopad.parse_any_input(b'{ "text": "x" }', TEST_MESSAGE, None, "binary")
+
+
+class TestDaemon:
+
+    @pytest.fixture
+    def server(self, protopad_home, monkeypatch):
+        types = {"TestMessage": TEST_MESSAGE, "Outer": OUTER, "Inner": INNER}
+
+        def get_message_desc(type_name):
+            if type_name not in types:
+                raise protopad.ProtopadError(f"Unknown message type '{type_name}'")
+            return types[type_name]
+
+        app = protopad.Protopad()
+        monkeypatch.setattr(app, "get_message_desc", get_message_desc)
+        server = protopad.ProtopadServer(app, str(protopad_home / "test.sock"))
+        server.poll_interval = 0.01
+
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(asyncio.run(server.run())))
+        thread.start()
+        while protopad.connect_to_daemon(server.socket_path) is None:
+            time.sleep(0.01)
+
+        yield server
+
+        # Rewriting the type index is how a recompile restarts the daemon.
+        with open(protopad.type_index_path(), "w") as f:
+            f.write("{}")
+        thread.join(timeout=5)
+        assert results == [True]
+        assert not os.path.exists(server.socket_path)
+
+    def request(self, server, request, payload):
+        with protopad.connect_to_daemon(server.socket_path) as sock:
+            return protopad.request_daemon(sock, request, payload)
+
+    def test_converts_json_and_proto(self, server):
+        binary = self.request(server, {"task": "proto", "type": "Outer", "internal_type": "Inner"},
+                              b'{ "inner": { "number": 5 } }')
+        assert protopad.message_class(OUTER).FromString(binary).inner == b"\x08\x05"
+
+        result = self.request(server, {"task": "json", "type": "Outer", "internal_type": "Inner"}, binary)
+        assert json.loads(result) == {"inner": {"number": 5}}
+
+    def test_reports_errors(self, server):
+        with pytest.raises(protopad.ProtopadError, match="Unknown message type"):
+            self.request(server, {"task": "json", "type": "Missing"}, b"")
+
+    def test_unexpected_errors_only_fail_the_request(self, server, monkeypatch):
+        convert = server.convert
+
+        def failing_convert(request, payload):
+            if request["type"] == "Broken":
+                raise RuntimeError("boom")
+            return convert(request, payload)
+
+        monkeypatch.setattr(server, "convert", failing_convert)
+        with pytest.raises(protopad.ProtopadError, match="RuntimeError: boom"):
+            self.request(server, {"task": "json", "type": "Broken"}, b"")
+        assert json.loads(self.request(server, {"task": "json", "type": "TestMessage"}, b"\n\x01x")) == {"text": "x"}
+
+    def test_profiles_concurrent_clients(self, server, monkeypatch):
+        profiler = protopad.Profiler()
+        profiler.enabled = True
+        monkeypatch.setattr(protopad, "_profiler", profiler)
+        self.test_handles_concurrent_clients(server)
+        assert profiler.take()["parse_json"]["count"] == 32
+
+    def test_handles_concurrent_clients(self, server):
+        def convert(i):
+            payload = json.dumps({"text": f"message {i}"}).encode()
+            binary = self.request(server, {"task": "proto", "type": "TestMessage"}, payload)
+            return protopad.message_class(TEST_MESSAGE).FromString(binary).text
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+            texts = list(pool.map(convert, range(32)))
+        assert texts == [f"message {i}" for i in range(32)]
+
+    def test_incremental_output_skips_the_daemon(self, server, tmp_path, monkeypatch):
+        monkeypatch.setattr(protopad, "SOCKET_PATH", server.socket_path)
+        (tmp_path / "in.json").write_text('{"text": "x"}')
+        args = {"task": "json", "type": "TestMessage", "file": str(tmp_path / "in.json"),
+                "output": str(tmp_path / "out.json")}
+        app = protopad.Protopad()
+        assert not app.convert_with_daemon(dict(args, incremental=True))
+        assert app.convert_with_daemon(args)
+        assert json.loads((tmp_path / "out.json").read_text()) == {"text": "x"}
+
+    def test_refuses_to_start_twice(self, server):
+        with pytest.raises(protopad.ProtopadError, match="already listening"):
+            asyncio.run(protopad.ProtopadServer(server.app, server.socket_path).run())
+
+
+class TestReadAnyInput:
+
+    @pytest.fixture(params=["python", "upb"])
+    def backend(self, request, monkeypatch):
+        monkeypatch.setattr(protopad, "protobuf_backend", lambda: request.param)
+        return request.param
+
+    def test_reads_binary_files(self, tmp_path, backend):
+        message = protopad.message_class(TEST_MESSAGE)(text="x" * 100000)
+        (tmp_path / "in.bin").write_bytes(message.SerializeToString())
+        assert protopad.read_any_input(TEST_MESSAGE, None, str(tmp_path / "in.bin")) == message
+
+    def test_reads_json_files(self, tmp_path, backend):
+        (tmp_path / "in.json").write_text('{ "text": "café" }')
+        assert protopad.read_any_input(TEST_MESSAGE, None, str(tmp_path / "in.json")).text == "café"
+
+    def test_reads_empty_files(self, tmp_path, backend):
+        (tmp_path / "empty").write_bytes(b"")
+        assert protopad.read_any_input(TEST_MESSAGE, None, str(tmp_path / "empty")).text == ""
+
+    def test_reports_decode_errors(self, tmp_path, backend):
+        (tmp_path / "in.bin").write_bytes(b"\n\x05ab")
+        with pytest.raises(protopad.ProtopadError):
+            protopad.read_any_input(TEST_MESSAGE, None, str(tmp_path / "in.bin"))
+
+    def test_mapped_buffer_is_released(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(protopad, "protobuf_backend", lambda: "python")
+        (tmp_path / "in.bin").write_bytes(b"\n\x01x")
+        with protopad.open_input_buffer(str(tmp_path / "in.bin")) as data:
+            view = data
+            assert bytes(view) == b"\n\x01x"
+        with pytest.raises(ValueError):
+            view[0]
+
+
+class TestImports:
+
+    def test_import_does_not_load_protobuf(self):
+        script = "import sys, protopad; print(any(name.startswith('google.protobuf') for name in sys.modules))"
+        output = subprocess.run(
+            [sys.executable, "-c", script],
+            env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__))),
+            stdout=subprocess.PIPE, check=True).stdout
+        assert output.strip() == b"False"
+
+    def test_protobuf_modules_are_imported_once(self, monkeypatch):
+        monkeypatch.setattr(protopad, "_protobuf_modules", {})
+        module = protopad.protobuf_module("json_format")
+        assert module.__name__ == "google.protobuf.json_format"
+        assert protopad.protobuf_module("json_format") is module
+        assert list(protopad._protobuf_modules) == ["json_format"]
+
+
+class TestProtobufVersion:
+
+    @pytest.mark.parametrize("version", ["4.21.0", "4.21.0rc2", "5.27.1", "31.1"])
+    def test_accepts_supported_versions(self, version, monkeypatch):
+        import google.protobuf
+        monkeypatch.setattr(google.protobuf, "__version__", version)
+        assert protopad.check_protobuf_version() == version
+
+    @pytest.mark.parametrize("version", ["3.20.3", "4.20.1"])
+    def test_rejects_older_versions(self, version, monkeypatch, capsys):
+        import google.protobuf
+        monkeypatch.setattr(google.protobuf, "__version__", version)
+        with pytest.raises(SystemExit):
+            protopad.check_protobuf_version()
+        assert "Requires at least version 4.21.0" in capsys.readouterr().err